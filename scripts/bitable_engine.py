@@ -9,13 +9,29 @@ import csv
 import json
 import os
 import sys
-import time
+from collections import Counter
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Tuple, Any
 
 import feishu_api as api
 
 
+# 分片并发数上限；单片条数取 api.BATCH_LIMIT，实际请求速率由共享限流器兜底
+MAX_WORKERS = 8
+
+
+def _run_chunks(fn, app_token: str, table_id: str, items: List[Dict]) -> Tuple[int, List[Dict]]:
+    """按 api.BATCH_LIMIT 分片并发提交，返回 (成功条数, 失败分片列表)"""
+    done = 0
+    errors = []
+    for offset, chunk, _, error in api.run_batches(fn, app_token, table_id, items, MAX_WORKERS):
+        if error is None:
+            done += len(chunk)
+        else:
+            errors.append({"offset": offset, "count": len(chunk), "error": str(error)})
+    return done, errors
+
+
 # ============================================================
 # 批量创建
 # ============================================================
@@ -29,18 +45,7 @@ def batch_create(app_token: str, table_id: str, records: List[Dict], dry_run: bo
     if dry_run:
         return {"would_create": total, "sample": records[:3]}
 
-    created = 0
-    errors = []
-    for i in range(0, total, 500):
-        chunk = records[i : i + 500]
-        try:
-            result = api.bitable_batch_create_records(app_token, table_id, chunk)
-            created += len(chunk)
-            if i + 500 < total:
-                time.sleep(0.5)  # 避免限流
-        except Exception as e:
-            errors.append({"offset": i, "count": len(chunk), "error": str(e)})
-
+    created, errors = _run_chunks(api.bitable_batch_create_records, app_token, table_id, records)
     return {"created": created, "total": total, "errors": errors}
 
 
@@ -59,18 +64,7 @@ def batch_update(app_token: str, table_id: str, updates: List[Dict], dry_run: bo
     if dry_run:
         return {"would_update": total, "sample": updates[:3]}
 
-    updated = 0
-    errors = []
-    for i in range(0, total, 500):
-        chunk = updates[i : i + 500]
-        try:
-            api.bitable_batch_update_records(app_token, table_id, chunk)
-            updated += len(chunk)
-            if i + 500 < total:
-                time.sleep(0.5)
-        except Exception as e:
-            errors.append({"offset": i, "count": len(chunk), "error": str(e)})
-
+    updated, errors = _run_chunks(api.bitable_batch_update_records, app_token, table_id, updates)
     return {"updated": updated, "total": total, "errors": errors}
 
 
@@ -88,30 +82,58 @@ def cross_table_join(
     """跨表 JOIN 查询
     在 left_table 和 right_table 之间按 join_field 做内连接
     """
-    left_records = api.bitable_list_all_records(app_token, left_table)
-    right_records = api.bitable_list_all_records(app_token, right_table)
-
-    # 构建右表索引
-    right_index: Dict[str, List[Dict]] = {}
-    for r in right_records:
-        fields = r.get("fields", {})
-        key = _extract_text_value(fields.get(join_field))
+    return list(iter_cross_table_join(app_token, left_table, right_table, join_field, select_fields))
+
+
+def iter_cross_table_join(
+    app_token: str,
+    left_table: str,
+    right_table: str,
+    join_field: str,
+    select_fields: Optional[List[str]] = None,
+) -> Iterator[Dict]:
+    """流式 JOIN：右表整表建索引，左表边分页读取边探测、逐行产出结果"""
+    # build：右表只建 key → 首行号，同 key 的后续行号串在 right_next 里（-1 结尾），
+    # 不为每个 key 分配 list。两侧 key 都 intern，命中时 dict 比较走对象同一性，不再逐字符比对
+    right_rows = [r.get("fields", {}) for r in api.bitable_iter_all_records(app_token, right_table)]
+    right_head: Dict[str, int] = {}
+    right_next = [-1] * len(right_rows)
+    for ri in range(len(right_rows) - 1, -1, -1):
+        key = _extract_text_value(right_rows[ri].get(join_field))
         if key:
-            right_index.setdefault(key, []).append(fields)
+            if type(key) is str:  # 数字等非文本 key 原样作键
+                key = sys.intern(key)
+            right_next[ri] = right_head.get(key, -1)
+            right_head[key] = ri
+
+    # 指定输出字段时右表转列存，物化时只取 select_fields；(字段名, 列) 对预先固定成元组，
+    # 探测循环里不再按字段名查列
+    if select_fields:
+        right_cols = _project_columns(right_rows, select_fields)
+        projection = tuple((name, right_cols[name]) for name in dict.fromkeys(select_fields))
+    else:
+        projection = None
 
-    # JOIN
-    results = []
-    for lr in left_records:
+    # probe：左表逐行探测，命中才物化输出行
+    for lr in api.bitable_iter_all_records(app_token, left_table):
         left_fields = lr.get("fields", {})
         key = _extract_text_value(left_fields.get(join_field))
-        if key and key in right_index:
-            for right_fields in right_index[key]:
-                merged = {**left_fields, **right_fields}
-                if select_fields:
-                    merged = {k: v for k, v in merged.items() if k in select_fields}
-                results.append(merged)
-
-    return results
+        if type(key) is str:
+            key = sys.intern(key)
+        ri = right_head.get(key, -1) if key else -1
+        while ri >= 0:
+            if projection is None:
+                yield {**left_fields, **right_rows[ri]}
+            else:
+                merged = {}
+                for name, col in projection:
+                    value = col[ri]
+                    if value is _MISSING:
+                        value = left_fields.get(name, _MISSING)
+                    if value is not _MISSING:
+                        merged[name] = value
+                yield merged
+            ri = right_next[ri]
 
 
 # ============================================================
@@ -122,29 +144,59 @@ def snapshot(
     app_token: str,
     table_id: str,
     output_dir: str = "snapshots",
+    pretty: bool = False,
+    fmt: str = "ndjson",
 ) -> str:
-    """导出当前表数据为 JSON 快照"""
+    """导出当前表数据快照
+
+    fmt="ndjson"（默认）：第一行是表头（字段、记录数等），之后每行一条记录，
+    逐条编码写入 1MB 缓冲文件，编码内存与记录数无关，也便于逐行读取；
+    fmt="json"：单个 JSON 文档，records 逐条序列化拼接，pretty=True 时按 indent=2 输出（ndjson 不支持 pretty）。
+    两种格式都用 api.dumps_json 编码，能写进 ndjson 的记录也能写进 json。
+    """
+    if fmt not in ("ndjson", "json"):
+        raise ValueError(f"不支持的快照格式: {fmt}")
+    if pretty and fmt != "json":
+        raise ValueError("pretty 只适用于 json 格式（ndjson 每行必须是一条完整记录）")
     os.makedirs(output_dir, exist_ok=True)
 
-    fields = api.bitable_list_fields(app_token, table_id)
-    records = api.bitable_list_all_records(app_token, table_id)
+    fields, records = api.run_concurrently(
+        (api.bitable_list_fields, app_token, table_id),
+        (api.bitable_list_all_records, app_token, table_id),
+    )
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{table_id}_{timestamp}.json"
+    filename = f"{table_id}_{timestamp}.{fmt}"
     filepath = os.path.join(output_dir, filename)
 
-    snapshot_data = {
+    header = {
         "app_token": app_token,
         "table_id": table_id,
         "snapshot_time": datetime.now().isoformat(),
         "field_count": len(fields),
         "record_count": len(records),
         "fields": [{"name": f.get("field_name"), "type": f.get("type")} for f in fields],
-        "records": [{"record_id": r.get("record_id"), "fields": r.get("fields", {})} for r in records],
     }
-
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(snapshot_data, f, ensure_ascii=False, indent=2)
+    rows = ({"record_id": r.get("record_id"), "fields": r.get("fields", {})} for r in records)
+
+    if fmt == "ndjson":
+        with open(filepath, "wb", buffering=1 << 20) as f:
+            f.write(api.dumps_json(header) + b"\n")
+            for row in rows:
+                f.write(api.dumps_json(row) + b"\n")
+        return filepath
+
+    with open(filepath, "wb", buffering=1 << 20) as f:
+        if pretty:
+            f.write(api.dumps_json({**header, "records": list(rows)}, pretty=True))
+        else:
+            f.write(api.dumps_json(header)[:-1])
+            f.write(b',"records":[')
+            for i, row in enumerate(rows):
+                if i:
+                    f.write(b",")
+                f.write(api.dumps_json(row))
+            f.write(b"]}")
 
     return filepath
 
@@ -155,8 +207,10 @@ def snapshot(
 
 def stats(app_token: str, table_id: str) -> Dict:
     """生成数据表统计摘要"""
-    fields = api.bitable_list_fields(app_token, table_id)
-    records = api.bitable_list_all_records(app_token, table_id)
+    fields, records = api.run_concurrently(
+        (api.bitable_list_fields, app_token, table_id),
+        (api.bitable_list_all_records_cached, app_token, table_id),
+    )
 
     summary = {
         "table_id": table_id,
@@ -165,35 +219,47 @@ def stats(app_token: str, table_id: str) -> Dict:
         "fields": [],
     }
 
-    for field in fields:
-        fname = field.get("field_name", "")
-        ftype = field.get("type", 0)
-        field_stat = {"name": fname, "type": ftype, "type_name": _field_type_name(ftype)}
+    # 一次遍历所有记录，把每个字段的值落到各自的列缓冲里
+    names = [f.get("field_name", "") for f in fields]
+    types = [f.get("type", 0) for f in fields]
+    filled = [0] * len(fields)
+    num_cols: Dict[int, List] = {i: [] for i, t in enumerate(types) if t == 2}  # Number
+    sel_cols: Dict[int, Counter] = {i: Counter() for i, t in enumerate(types) if t in (3, 4)}  # SingleSelect / MultiSelect
+    for r in records:
+        row = r.get("fields", {})
+        for i, fname in enumerate(names):
+            v = row.get(fname)
+            if v is None or v == "" or v == []:
+                continue
+            filled[i] += 1
+            if i in num_cols:
+                if isinstance(v, (int, float)):
+                    num_cols[i].append(v)
+            elif i in sel_cols:
+                counter = sel_cols[i]
+                if isinstance(v, str):
+                    counter[v] += 1
+                elif isinstance(v, list):
+                    counter.update(item if isinstance(item, str) else str(item) for item in v)
 
-        values = [r.get("fields", {}).get(fname) for r in records]
-        non_null = [v for v in values if v is not None and v != "" and v != []]
-        field_stat["fill_rate"] = f"{len(non_null)}/{len(records)}" if records else "0/0"
+    for i, fname in enumerate(names):
+        ftype = types[i]
+        field_stat = {"name": fname, "type": ftype, "type_name": _field_type_name(ftype)}
+        field_stat["fill_rate"] = f"{filled[i]}/{len(records)}" if records else "0/0"
 
         # 数值字段统计
-        if ftype == 2:  # Number
-            nums = [v for v in non_null if isinstance(v, (int, float))]
+        if i in num_cols:
+            nums = num_cols[i]
             if nums:
+                total = sum(nums)
                 field_stat["min"] = min(nums)
                 field_stat["max"] = max(nums)
-                field_stat["avg"] = round(sum(nums) / len(nums), 2)
-                field_stat["sum"] = round(sum(nums), 2)
+                field_stat["avg"] = round(total / len(nums), 2)
+                field_stat["sum"] = round(total, 2)
 
         # 单选/多选统计
-        elif ftype in (3, 4):  # SingleSelect / MultiSelect
-            counter: Dict[str, int] = {}
-            for v in non_null:
-                if isinstance(v, str):
-                    counter[v] = counter.get(v, 0) + 1
-                elif isinstance(v, list):
-                    for item in v:
-                        val = item if isinstance(item, str) else str(item)
-                        counter[val] = counter.get(val, 0) + 1
-            field_stat["distribution"] = dict(sorted(counter.items(), key=lambda x: -x[1])[:10])
+        elif i in sel_cols:
+            field_stat["distribution"] = dict(sel_cols[i].most_common(10))
 
         summary["fields"].append(field_stat)
 
@@ -220,17 +286,19 @@ def load_records_from_file(filepath: str) -> List[Dict]:
 
     elif ext == ".csv":
         records = []
-        with open(filepath, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
+        with open(filepath, "r", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if not header:
+                return records
+            width = len(header)
             for row in reader:
-                # 尝试自动转换数值
-                record = {}
-                for k, v in row.items():
-                    try:
-                        record[k] = float(v) if "." in v else int(v)
-                    except (ValueError, TypeError):
-                        record[k] = v
-                records.append(record)
+                if not row:
+                    continue
+                if len(row) < width:
+                    row += [None] * (width - len(row))
+                # 自动转换数值
+                records.append({header[i]: _cast_cell(row[i]) for i in range(width)})
         return records
 
     else:
@@ -241,26 +309,71 @@ def load_records_from_file(filepath: str) -> List[Dict]:
 # 辅助函数
 # ============================================================
 
+_MISSING = object()
+
+
+def _project_columns(rows: List[Dict], names: List[str]) -> Dict[str, List[Any]]:
+    """行存 → 列存，只保留需要的字段，缺失值用 _MISSING 占位"""
+    return {name: [row.get(name, _MISSING) for row in rows] for name in names}
+
+
+def _cast_cell(v: Optional[str]) -> Any:
+    """CSV 单元格自动转数值：含 "." 的按 float，否则按 int，转不了保留原字符串
+
+    纯数字先用字符判断直接转换；只有带下划线或指数的写法（如 "1_000"、"1.5e3"）才交给 int/float 试，
+    普通文本不走 try/except
+    """
+    if not v:
+        return v
+    body = v.strip()
+    if body[:1] in "+-":
+        body = body[1:]
+    if "." in v:
+        if body.replace(".", "", 1).isdecimal():
+            return float(v)
+        maybe_number = "_" in v or "e" in v or "E" in v
+    elif body.isdecimal():
+        return int(v)
+    else:
+        maybe_number = "_" in v
+    if maybe_number:
+        try:
+            return float(v) if "." in v else int(v)
+        except ValueError:
+            pass
+    return v
+
+
 def _extract_text_value(value: Any) -> Optional[str]:
-    """从飞书字段值中提取纯文本"""
-    if value is None:
-        return None
-    if isinstance(value, str):
-        return value
-    if isinstance(value, (int, float)):
-        return str(value)
-    if isinstance(value, list):
-        # 富文本字段: [{"text": "xxx", ...}]
-        texts = []
-        for item in value:
-            if isinstance(item, dict):
-                texts.append(item.get("text", ""))
-            elif isinstance(item, str):
-                texts.append(item)
-        return "".join(texts) if texts else None
-    if isinstance(value, dict):
-        return value.get("text") or value.get("value") or str(value)
-    return str(value)
+    """从飞书字段值中提取纯文本（按值类型查表分派）"""
+    fn = _TEXT_EXTRACTORS.get(type(value))
+    return fn(value) if fn else str(value)
+
+
+def _text_from_list(value: List) -> Optional[str]:
+    # 富文本字段: [{"text": "xxx", ...}]
+    texts = []
+    for item in value:
+        if isinstance(item, dict):
+            texts.append(item.get("text", ""))
+        elif isinstance(item, str):
+            texts.append(item)
+    return "".join(texts) if texts else None
+
+
+def _text_from_dict(value: Dict) -> str:
+    return value.get("text") or value.get("value") or str(value)
+
+
+_TEXT_EXTRACTORS = {
+    type(None): lambda v: None,
+    str: lambda v: v,
+    int: str,
+    float: str,
+    bool: str,
+    list: _text_from_list,
+    dict: _text_from_dict,
+}
 
 
 def _field_type_name(ftype: int) -> str:
@@ -326,6 +439,8 @@ def main():
     p_snap.add_argument("--app", required=True, help="App token")
     p_snap.add_argument("--table", required=True, help="Table ID")
     p_snap.add_argument("--output", default="snapshots", help="输出目录")
+    p_snap.add_argument("--format", choices=["ndjson", "json"], default="ndjson", help="输出格式（默认 ndjson，每行一条记录）")
+    p_snap.add_argument("--pretty", action="store_true", help="缩进输出，仅用于 --format json（体积更大、更慢）")
 
     # stats
     p_stats = sub.add_parser("stats", help="统计摘要")
@@ -351,30 +466,32 @@ def main():
     if args.command == "batch-create":
         records = load_records_from_file(args.data)
         result = batch_create(args.app, args.table, records, args.dry_run)
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        api.print_json(result)
 
     elif args.command == "batch-update":
         updates = load_records_from_file(args.data)
         result = batch_update(args.app, args.table, updates, args.dry_run)
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        api.print_json(result)
 
     elif args.command == "join":
         select = args.select.split(",") if args.select else None
         results = cross_table_join(args.app, args.left, args.right, args.on, select)
-        print(json.dumps(results, ensure_ascii=False, indent=2))
+        api.print_json(results)
 
     elif args.command == "snapshot":
-        filepath = snapshot(args.app, args.table, args.output)
+        if args.pretty and args.format != "json":
+            parser.error("--pretty 只能与 --format json 一起使用")
+        filepath = snapshot(args.app, args.table, args.output, pretty=args.pretty, fmt=args.format)
         print(f"快照已保存: {filepath}")
 
     elif args.command == "stats":
         result = stats(args.app, args.table)
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        api.print_json(result)
 
     elif args.command in ("import-csv", "import-json"):
         records = load_records_from_file(args.file)
         result = batch_create(args.app, args.table, records, args.dry_run)
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        api.print_json(result)
 
 
 if __name__ == "__main__":
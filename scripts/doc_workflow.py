@@ -9,8 +9,10 @@ import json
 import os
 import re
 import sys
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple, Any
 
 import feishu_api as api
 
@@ -19,6 +21,87 @@ import feishu_api as api
 # 模板引擎
 # ============================================================
 
+# 变量名 / 块参数：字母数字下划线、点号、中文
+_KEY_RE = re.compile(r'[\w.\u4e00-\u9fff]+')
+
+
+class Template:
+    """预编译模板：源码只解析一次为操作码树，渲染时遍历操作码
+
+    操作码：
+      ("lit", 文本)
+      ("var", 名称, 可查上下文, 原文)   # 未解析到时原样保留
+      ("each", 点号路径, 循环体操作码)
+      ("if", 点号路径, 子操作码)
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.ops = _parse(source)
+        # 不含块的模板（只有文本和变量）渲染时走 _render_flat，省掉解析闭包、备忘表和操作码分派
+        self.flat = all(op[0] == "lit" or op[0] == "var" for op in self.ops)
+
+    @classmethod
+    def from_path(cls, path: str) -> "Template":
+        """从文件加载模板，按 (路径, mtime) 缓存编译结果"""
+        path = os.path.abspath(path)
+        return _template_from_path(path, os.stat(path).st_mtime)
+
+    def render(self, context: Dict[str, Any]) -> str:
+        ctx = context if type(context) is dict else dict(context)
+        if self.flat:
+            return self._render_flat(ctx)
+        builtins: List[Dict[str, str]] = []  # 内置日期变量用到时才取，一次渲染最多取一次
+
+        # 同一次渲染内，点号路径只解析一次
+        memo: Dict[str, Any] = {}
+
+        def resolve(key: str) -> Any:
+            if key not in memo:
+                root = key.partition(".")[0]
+                if root in ctx or root not in _BUILTIN_NAMES:
+                    memo[key] = _resolve_dotted(ctx, key)
+                else:  # 上下文同名字段优先于内置变量
+                    if not builtins:
+                        builtins.append(_builtin_vars())
+                    memo[key] = _resolve_dotted(builtins[0], key)
+            return memo[key]
+
+        out: List[str] = []
+        _exec_ops(self.ops, resolve, out)
+        return "".join(out)
+
+    def _render_flat(self, ctx: Dict[str, Any]) -> str:
+        """无块模板：逐个操作码直接取值，语义与 render 里的 resolve + _exec_ops 一致"""
+        builtins = None
+        out: List[str] = []
+        for op in self.ops:
+            if op[0] == "lit":
+                out.append(op[1])
+                continue
+            val = None
+            if op[2]:
+                key = op[1]
+                if "." not in key and key in ctx:  # 大多数变量是上下文里的单层字段名
+                    val = ctx[key]
+                else:
+                    root = key.partition(".")[0]
+                    if root in ctx or root not in _BUILTIN_NAMES:
+                        val = _resolve_dotted(ctx, key)
+                    else:  # 上下文同名字段优先于内置变量
+                        if builtins is None:
+                            builtins = _builtin_vars()
+                        val = _resolve_dotted(builtins, key)
+            out.append(_to_str(val) if val is not None else op[3])
+        return "".join(out)
+
+
+@lru_cache(maxsize=128)
+def _template_from_path(path: str, mtime: float) -> Template:
+    with open(path, "r", encoding="utf-8") as f:
+        return Template(f.read())
+
+
 def render_template(template: str, context: Dict[str, Any]) -> str:
     """渲染模板，支持 {{变量}} 和 {{#each 列表}}...{{/each}} 语法
     
@@ -27,86 +110,211 @@ def render_template(template: str, context: Dict[str, Any]) -> str:
     条件: {{#if flag}}...{{/if}}
     内置变量: {{TODAY}}, {{YESTERDAY}}, {{WEEK_START}}, {{WEEK_END}}, {{NOW}}
     """
-    # 注入内置变量
+    return _template_from_source(template).render(context)
+
+
+@lru_cache(maxsize=256)
+def _template_from_source(source: str) -> Template:
+    """同一模板串反复渲染时复用 Template 实例（操作码本身已由 _parse 缓存）"""
+    return Template(source)
+
+
+_BUILTIN_NAMES = frozenset(("TODAY", "YESTERDAY", "WEEK_START", "WEEK_END", "NOW"))
+
+
+def _builtin_vars() -> Dict[str, str]:
+    """内置日期变量"""
     today = datetime.now()
-    builtins = {
+    return {
         "TODAY": today.strftime("%Y-%m-%d"),
         "YESTERDAY": (today - timedelta(days=1)).strftime("%Y-%m-%d"),
         "WEEK_START": (today - timedelta(days=today.weekday())).strftime("%Y-%m-%d"),
         "WEEK_END": (today - timedelta(days=today.weekday()) + timedelta(days=6)).strftime("%Y-%m-%d"),
         "NOW": today.strftime("%Y-%m-%d %H:%M"),
     }
-    ctx = {**builtins, **context}
-
-    result = template
-
-    # 处理 {{#each list}}...{{/each}}
-    each_pattern = re.compile(r'\{\{#each\s+([\w.]+)\}\}(.*?)\{\{/each\}\}', re.DOTALL)
-    def replace_each(m):
-        key = m.group(1)
-        body = m.group(2).strip("\n")  # 去掉循环体首尾换行
-        items = _resolve_dotted(ctx, key)
-        if not isinstance(items, list):
-            return ""
-        lines = []
-        for idx, item in enumerate(items):
-            line = body
-            if isinstance(item, dict):
-                # 跳过全空记录
-                if all(v is None or v == "" or v == [] for v in item.values()):
-                    continue
-                # 处理循环体内的 {{#if field}}...{{/if}}（访问当前迭代项字段）
-                line = _resolve_inner_if(line, item)
-                for k, v in item.items():
-                    line = line.replace("{{" + k + "}}", _to_str(v))
-                line = line.replace("{{@index}}", str(idx))
+
+
+def _tokenize(source: str) -> Iterator[Tuple]:
+    """单遍线性扫描模板源码，切成标记流，不依赖回溯正则
+
+    ("lit", 文本) / ("var", 名称, 原文) / ("open", "each"|"if", 键, 原文) / ("close", "each"|"if", 原文)
+    """
+    pos = lit_from = 0
+    while True:
+        start = source.find("{{", pos)
+        if start < 0:
+            break
+        end = source.find("}}", start + 2)
+        if end < 0:
+            break
+        # 占位符内部不含花括号："{{{x}}" 从最右边的 "{{" 算起，"{{a}b}}" 不是占位符
+        start = source.rfind("{{", start, end)
+        inner = source[start + 2:end]
+        if "{" in inner or "}" in inner:
+            pos = start + 2
+            continue
+        if lit_from < start:
+            yield ("lit", source[lit_from:start])
+        yield _classify_tag(inner, source[start:end + 2])
+        pos = lit_from = end + 2
+    if lit_from < len(source):
+        yield ("lit", source[lit_from:])
+
+
+def _classify_tag(inner: str, raw: str) -> Tuple:
+    for kind in ("each", "if"):
+        if inner.startswith("#" + kind):
+            rest = inner[len(kind) + 1:]
+            key = rest.lstrip()
+            if rest[:1].isspace() and _KEY_RE.fullmatch(key):
+                return ("open", kind, key, raw)
+    if inner == "/each" or inner == "/if":
+        return ("close", inner[1:], raw)
+    return ("var", inner, raw)
+
+
+@lru_cache(maxsize=256)
+def _parse(source: str) -> Tuple:
+    """标记流 → 操作码树，块标签用栈配对
+
+    不配对的结束标签、未闭合的开始标签按原文输出，块内内容并回上一层。
+    """
+    children: List[Tuple] = []
+    stack: List[Tuple] = []  # (块类型, 键, 原文, 上一层 children)
+    for tok in _tokenize(source):
+        kind = tok[0]
+        if kind == "lit":
+            children.append(tok)
+        elif kind == "var":
+            # 字段名驻留：与同样驻留的记录字段名（build_context_from_bitable）比较时直接比指针
+            children.append(("var", sys.intern(tok[1]), _KEY_RE.fullmatch(tok[1]) is not None, tok[2]))
+        elif kind == "open":
+            stack.append((tok[1], sys.intern(tok[2]), tok[3], children))
+            children = []
+        elif not any(frame[0] == tok[1] for frame in stack):
+            children.append(("lit", tok[2]))
+        else:
+            while True:
+                block, key, raw, parent = stack.pop()
+                if block == tok[1]:
+                    body = _block_body(block, children)
+                    parent.append((block, key, body))
+                    children = parent
+                    break
+                parent.append(("lit", raw))
+                parent.extend(children)
+                children = parent
+    while stack:
+        _, _, raw, parent = stack.pop()
+        parent.append(("lit", raw))
+        parent.extend(children)
+        children = parent
+    return tuple(_merge_lits(children))
+
+
+def _merge_lits(ops: List[Tuple]) -> List[Tuple]:
+    """合并相邻的文本操作码"""
+    merged: List[Tuple] = []
+    for op in ops:
+        if op[0] == "lit" and merged and merged[-1][0] == "lit":
+            merged[-1] = ("lit", merged[-1][1] + op[1])
+        else:
+            merged.append(op)
+    return merged
+
+
+def _block_body(block: str, children: List[Tuple]) -> Tuple:
+    ops = _merge_lits(children)
+    if block == "each":
+        # 去掉循环体首尾换行
+        if ops and ops[0][0] == "lit":
+            ops[0] = ("lit", ops[0][1].lstrip("\n"))
+        if ops and ops[-1][0] == "lit":
+            ops[-1] = ("lit", ops[-1][1].rstrip("\n"))
+        ops = [op for op in ops if op != ("lit", "")]
+    return tuple(ops)
+
+
+def _exec_ops(ops: Tuple, resolve, out: List[str]):
+    for op in ops:
+        kind = op[0]
+        if kind == "lit":
+            out.append(op[1])
+        elif kind == "var":
+            # 变量：支持点号访问嵌套字段和中文字段名，未解析到的保留原样
+            val = resolve(op[1]) if op[2] else None
+            out.append(_to_str(val) if val is not None else op[3])
+        elif kind == "if":
+            # 假值分支连同其中的变量、嵌套块整段跳过；内置类型里真值必然 != [] 且 != 0，
+            # 一次 bool 判断即可，省去每个真值分支的两次跨类型比较
+            if resolve(op[1]):
+                _exec_ops(op[2], resolve, out)
+        else:
+            _render_each(op, resolve(op[1]), resolve, out)
+
+
+def _render_each(op: Tuple, items: Any, resolve, out: List[str]):
+    """展开 {{#each}} 循环，每个迭代项一行"""
+    if not isinstance(items, list):
+        return
+    body = op[2]
+    # 各项直接写进调用方的缓冲区、项间补换行，最后随整篇一次 join，不为每项单独建列表再拼接
+    memo: Dict[float, str] = {}  # 本次循环内浮点数 → 字符串，重复金额/比例只格式化一次
+    sep = ""
+    for idx, item in enumerate(items):
+        if isinstance(item, dict):
+            # 跳过全空记录
+            if all(v is None or v == "" or v == [] for v in item.values()):
+                continue
+        out.append(sep)
+        _render_item(body, item, idx, resolve, out, memo)
+        sep = "\n"
+
+
+def _render_item(ops: Tuple, item: Any, idx: int, resolve, out: List[str], memo: Dict[float, str]):
+    """渲染一个迭代项
+
+    dict 项：变量取当前迭代项字段，取不到的回落到全局上下文；{{#if field}} 只看迭代项字段；
+    {{@index}} 为序号。其他项：{{this}} 为迭代项本身，其余变量和条件取全局上下文。
+    嵌套 {{#each}} 优先取迭代项里的同名列表，没有再取全局上下文。
+    """
+    is_dict = isinstance(item, dict)
+    for op in ops:
+        kind = op[0]
+        if kind == "lit":
+            out.append(op[1])
+        elif kind == "var":
+            name = op[1]
+            if is_dict and name in item:
+                val = item[name]
+                if type(val) is float:
+                    text = memo.get(val)
+                    if text is None:
+                        text = memo[val] = _to_str(val)
+                    out.append(text)
+                else:
+                    out.append(_to_str(val))
+            elif is_dict and name == "@index":
+                out.append(str(idx))
+            elif not is_dict and name == "this":
+                out.append(_to_str(item))
             else:
-                line = line.replace("{{this}}", _to_str(item))
-            lines.append(line)
-        return "\n".join(lines)
-
-    result = each_pattern.sub(replace_each, result)
-
-    # 处理 {{#if key}}...{{/if}} — 支持点号路径和中文字段名
-    if_pattern = re.compile(r'\{\{#if\s+([\w.\u4e00-\u9fff]+)\}\}(.*?)\{\{/if\}\}', re.DOTALL)
-    def replace_if(m):
-        key = m.group(1)
-        body = m.group(2)
-        val = _resolve_dotted(ctx, key)
-        if val and val != [] and val != 0:
-            return body
-        return ""
-    result = if_pattern.sub(replace_if, result)
-
-    # 处理 {{variable}} — 支持点号访问嵌套字段和中文字段名
-    var_pattern = re.compile(r'\{\{([\w.\u4e00-\u9fff]+)\}\}')
-    def replace_var(m):
-        key = m.group(1)
-        val = _resolve_dotted(ctx, key)
-        return _to_str(val) if val is not None else m.group(0)
-    result = var_pattern.sub(replace_var, result)
-
-    return result
-
-
-def _resolve_inner_if(text: str, item: Dict[str, Any]) -> str:
-    """处理循环体内的 {{#if field}}...{{/if}}，从当前迭代项查找字段值"""
-    pattern = re.compile(r'\{\{#if\s+([\w.\u4e00-\u9fff]+)\}\}(.*?)\{\{/if\}\}', re.DOTALL)
-    def replace(m):
-        key = m.group(1)
-        body = m.group(2)
-        val = item.get(key)
-        if val and val != [] and val != 0:
-            return body
-        return ""
-    return pattern.sub(replace, text)
+                val = resolve(name) if op[2] else None
+                out.append(_to_str(val) if val is not None else op[3])
+        elif kind == "if":
+            if (item.get(op[1]) if is_dict else resolve(op[1])):
+                _render_item(op[2], item, idx, resolve, out, memo)
+        else:
+            items = item[op[1]] if is_dict and op[1] in item else resolve(op[1])
+            _render_each(op, items, resolve, out)
 
 
 def _resolve_dotted(ctx: Dict, key: str) -> Any:
     """解析点号路径: summary.total → ctx["summary"]["total"]"""
-    parts = key.split(".")
+    if "." not in key:  # 大多数变量是单层字段名
+        return ctx.get(key) if isinstance(ctx, dict) else None
     current = ctx
-    for p in parts:
+    for p in _path_parts(key):
         if isinstance(current, dict):
             current = current.get(p)
         else:
@@ -116,13 +324,24 @@ def _resolve_dotted(ctx: Dict, key: str) -> Any:
     return current
 
 
+@lru_cache(maxsize=1024)
+def _path_parts(key: str) -> Tuple[str, ...]:
+    """点号路径切分结果按路径缓存，模板里的路径是有限集合"""
+    return tuple(key.split("."))
+
+
 def _to_str(val: Any) -> str:
+    # 字符串和整数是最常见的字段值，按精确类型先返回，跳过后面的 isinstance 链
+    t = type(val)
+    if t is str:
+        return val
+    if t is int:
+        return str(val)
     if val is None:
         return ""
-    if isinstance(val, float):
-        if val == int(val):
-            return str(int(val))
-        return f"{val:.2f}"
+    if t is float or isinstance(val, float):
+        # is_integer 不经 int() 转换和跨类型比较；inf/nan 按 .2f 输出而不是抛异常
+        return str(int(val)) if val.is_integer() else f"{val:.2f}"
     if isinstance(val, list):
         return ", ".join(str(v) for v in val)
     return str(val)
@@ -154,19 +373,29 @@ def build_context_from_bitable(
         }
     }
     """
-    fields = api.bitable_list_fields(app_token, table_id)
-    records = api.bitable_list_all_records(app_token, table_id, filter_str=filter_str)
+    fields, records = api.run_concurrently(
+        (api.bitable_list_fields, app_token, table_id),
+        (api.bitable_list_all_records_cached, app_token, table_id, filter_str),
+    )
 
-    field_names = [f.get("field_name", "") for f in fields]
+    field_names = [sys.intern(f.get("field_name", "")) for f in fields]  # 与模板里驻留的变量名同一对象
     field_types = {f.get("field_name", ""): f.get("type", 0) for f in fields}
 
-    # 提取纯文本记录
+    # 提取纯文本记录：按值类型查表取提取函数，不逐格走 isinstance 链；标量原样保留，连查表带调用都省掉
+    extractors = _DISPLAY_EXTRACTORS
+    plain = _PLAIN_TYPES
     clean_records = []
     for r in records:
+        raw_fields = r.get("fields", {})
         row = {}
         for fname in field_names:
-            raw = r.get("fields", {}).get(fname)
-            row[fname] = _extract_display_value(raw, field_types.get(fname, 0))
+            raw = raw_fields.get(fname)
+            t = type(raw)
+            if t in plain:
+                row[fname] = raw
+            else:
+                fn = extractors.get(t)
+                row[fname] = fn(raw) if fn else str(raw)
         clean_records.append(row)
 
     ctx: Dict[str, Any] = {
@@ -184,29 +413,37 @@ def build_context_from_bitable(
         ctx["groups"] = groups
 
     # 自动统计：单选字段做分布，数值字段做汇总
+    # 一次遍历记录，值落到各字段的累加器里
+    num_cols: Dict[str, List] = {f: [] for f, t in field_types.items() if t == 2}  # Number
+    sel_cols: Dict[str, Counter] = {f: Counter() for f, t in field_types.items() if t == 3}  # SingleSelect
+    for row in clean_records:
+        for fname, buf in num_cols.items():
+            v = row.get(fname)
+            if not v:
+                continue
+            if isinstance(v, (int, float)):
+                buf.append(v)
+            elif isinstance(v, str):
+                try:
+                    buf.append(float(v))
+                except ValueError:
+                    pass
+        for fname, counter in sel_cols.items():
+            v = row.get(fname)
+            if v:
+                counter[str(v)] += 1
+
     summary: Dict[str, Any] = {"total": len(clean_records)}
-    for fname, ftype in field_types.items():
-        values = [r.get(fname) for r in clean_records if r.get(fname)]
-        if ftype == 3:  # SingleSelect
-            dist = {}
-            for v in values:
-                dist[str(v)] = dist.get(str(v), 0) + 1
-            summary[f"by_{fname}"] = dist
-        elif ftype == 2:  # Number
-            nums = []
-            for v in values:
-                if isinstance(v, (int, float)):
-                    nums.append(v)
-                elif isinstance(v, str):
-                    try:
-                        nums.append(float(v))
-                    except ValueError:
-                        pass
-            if nums:
-                summary[f"{fname}_sum"] = round(sum(nums), 2)
-                summary[f"{fname}_avg"] = round(sum(nums) / len(nums), 2)
-                summary[f"{fname}_max"] = max(nums)
-                summary[f"{fname}_min"] = min(nums)
+    for fname in field_types:
+        if fname in sel_cols:
+            summary[f"by_{fname}"] = dict(sel_cols[fname])
+        elif num_cols.get(fname):
+            nums = num_cols[fname]
+            total = sum(nums)
+            summary[f"{fname}_sum"] = round(total, 2)
+            summary[f"{fname}_avg"] = round(total / len(nums), 2)
+            summary[f"{fname}_max"] = max(nums)
+            summary[f"{fname}_min"] = min(nums)
     ctx["summary"] = summary
 
     # 合并额外上下文
@@ -217,33 +454,49 @@ def build_context_from_bitable(
 
 
 def _extract_display_value(raw: Any, ftype: int) -> Any:
-    """从飞书字段原始值提取可显示的值"""
-    if raw is None:
+    """从飞书字段原始值提取可显示的值（按值类型查表分派）"""
+    fn = _DISPLAY_EXTRACTORS.get(type(raw))
+    return fn(raw) if fn else str(raw)
+
+
+def _display_from_list(raw: List) -> Any:
+    # 富文本 / 多选 / 人员
+    if not raw:
         return None
-    if isinstance(raw, (str, int, float, bool)):
-        return raw
-    if isinstance(raw, list):
-        # 富文本 / 多选 / 人员
-        if not raw:
-            return None
-        first = raw[0]
-        if isinstance(first, dict):
-            if "text" in first:  # 富文本
-                return "".join(item.get("text", "") for item in raw)
-            if "name" in first:  # 人员
-                return ", ".join(item.get("name", "") for item in raw)
-            if "id" in first:  # 人员 (open_id)
-                return ", ".join(item.get("name", item.get("id", "")) for item in raw)
-        # 多选字符串列表
-        return [str(v) for v in raw]
-    if isinstance(raw, dict):
-        if "text" in raw:
-            return raw["text"]
-        if "link" in raw:
-            return raw["link"]
+    first = raw[0]
+    if isinstance(first, dict):
+        if "text" in first:  # 富文本
+            return "".join(item.get("text", "") for item in raw)
+        if "name" in first:  # 人员
+            return ", ".join(item.get("name", "") for item in raw)
+        if "id" in first:  # 人员 (open_id)
+            return ", ".join(item.get("name", item.get("id", "")) for item in raw)
+    # 多选字符串列表
+    return [str(v) for v in raw]
+
+
+def _display_from_dict(raw: Dict) -> Any:
+    if "text" in raw:
+        return raw["text"]
+    if "link" in raw:
+        return raw["link"]
     return str(raw)
 
 
+def _identity(raw: Any) -> Any:
+    return raw
+
+
+# 原样可显示的标量类型
+_PLAIN_TYPES = frozenset((type(None), str, int, float, bool))
+
+_DISPLAY_EXTRACTORS = {
+    **{t: _identity for t in _PLAIN_TYPES},
+    list: _display_from_list,
+    dict: _display_from_dict,
+}
+
+
 # ============================================================
 # 文档生成
 # ============================================================
@@ -267,10 +520,7 @@ def generate_doc(
     Returns:
         {"doc_token": "xxx", "url": "https://...", "title": "xxx"}
     """
-    with open(template_path, "r", encoding="utf-8") as f:
-        template = f.read()
-
-    rendered = render_template(template, context)
+    rendered = Template.from_path(template_path).render(context)
 
     # 提取标题
     if not title:
@@ -294,14 +544,7 @@ def generate_doc(
         raise Exception(f"创建文档失败: {doc_data}")
 
     # 写入内容：将 markdown 转为飞书 blocks，分批写入（每批最多 50 个）
-    blocks = _markdown_to_blocks(rendered)
-    BATCH_SIZE = 50
-    for i in range(0, len(blocks), BATCH_SIZE):
-        chunk = blocks[i : i + BATCH_SIZE]
-        api.docx_create_block(doc_token, doc_token, chunk)
-        if i + BATCH_SIZE < len(blocks):
-            import time
-            time.sleep(0.3)  # 避免限流
+    api.docx_append_blocks(doc_token, _markdown_to_blocks(rendered))
 
     url = f"https://my.feishu.cn/docx/{doc_token}"
     return {"doc_token": doc_token, "url": url, "title": title}
@@ -315,88 +558,104 @@ def _markdown_to_blocks(md: str) -> List[Dict]:
     blocks = []
     lines = md.split("\n")
     i = 0
+    n = len(lines)
 
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
+    while i < n:
+        stripped = lines[i].strip()
+        i += 1
 
         # 空行跳过
         if not stripped:
-            i += 1
             continue
 
-        # 分割线
-        if stripped in ("---", "***", "___"):
+        kind, level, text = _scan_line(stripped)
+
+        if kind == "divider":
             blocks.append({"block_type": 22, "divider": {}})
-            i += 1
-            continue
 
-        # 标题
-        heading_match = re.match(r'^(#{1,6})\s+(.+)$', stripped)
-        if heading_match:
-            level = len(heading_match.group(1))
-            text = heading_match.group(2)
+        elif kind == "heading":
             # 飞书 heading block_type: 3=h1, 4=h2, ..., 11=h9
-            block_type = 2 + level
             blocks.append({
-                "block_type": block_type,
+                "block_type": 2 + level,
                 f"heading{level}": {
                     "elements": [{"text_run": {"content": text}}]
                 }
             })
-            i += 1
-            continue
 
-        # 无序列表
-        if re.match(r'^[-*+]\s+', stripped):
-            text = re.sub(r'^[-*+]\s+', '', stripped)
+        elif kind == "bullet" or kind == "ordered":
             blocks.append({
                 "block_type": 2,
                 "text": {
                     "elements": [{"text_run": {"content": text}}],
-                    "style": {"list": "bullet"}
+                    "style": {"list": "bullet" if kind == "bullet" else "number"}
                 }
             })
-            i += 1
-            continue
 
-        # 有序列表
-        ol_match = re.match(r'^(\d+)\.\s+(.+)$', stripped)
-        if ol_match:
-            text = ol_match.group(2)
-            blocks.append({
-                "block_type": 2,
-                "text": {
-                    "elements": [{"text_run": {"content": text}}],
-                    "style": {"list": "number"}
-                }
-            })
-            i += 1
-            continue
-
-        # 表格：检测 | 开头的连续行
-        if stripped.startswith("|"):
-            table_lines = []
-            while i < len(lines) and lines[i].strip().startswith("|"):
+        elif kind == "table":
+            # 表格：收集 | 开头的连续行
+            table_lines = [stripped]
+            while i < n and lines[i].strip().startswith("|"):
                 table_lines.append(lines[i].strip())
                 i += 1
             table_block = _parse_table(table_lines)
             if table_block:
                 blocks.append(table_block)
-            continue
 
-        # 普通段落
-        blocks.append({
-            "block_type": 2,  # text
-            "text": {
-                "elements": [{"text_run": {"content": stripped}}]
-            }
-        })
-        i += 1
+        else:
+            # 普通段落
+            blocks.append({
+                "block_type": 2,  # text
+                "text": {
+                    "elements": [{"text_run": {"content": text}}]
+                }
+            })
 
     return blocks
 
 
+def _scan_line(s: str) -> Tuple[str, int, str]:
+    """按行首字符判定一行（已 strip、非空）的类型，不走正则
+
+    返回 (kind, level, text)，kind 取值：
+    divider / heading / bullet / ordered / table / text
+    """
+    c = s[0]
+    n = len(s)
+
+    if c == "#":
+        level = 1
+        while level < n and s[level] == "#":
+            level += 1
+        if level <= 6 and level < n and s[level].isspace():
+            return "heading", level, s[level:].lstrip()
+        return "text", 0, s
+
+    if c in "-*+":
+        if s in ("---", "***"):
+            return "divider", 0, s
+        if n > 1 and s[1].isspace():
+            return "bullet", 0, s[1:].lstrip()
+        return "text", 0, s
+
+    if c == "_" and s == "___":
+        return "divider", 0, s
+
+    if c == "|":
+        return "table", 0, s
+
+    if c.isdecimal():
+        j = 1
+        while j < n and s[j].isdecimal():
+            j += 1
+        if j + 1 < n and s[j] == "." and s[j + 1].isspace():
+            return "ordered", 0, s[j + 1:].lstrip()
+
+    return "text", 0, s
+
+
+_TABLE_SEP_RE = re.compile(r'^\|[\s\-:|]+\|$')
+
+
 def _parse_table(lines: List[str]) -> Optional[Dict]:
     """解析 Markdown 表格为飞书 table block
     
@@ -406,28 +665,23 @@ def _parse_table(lines: List[str]) -> Optional[Dict]:
     if len(lines) < 2:
         return None
 
-    # 解析表头和数据行
-    rows = []
-    for line in lines:
-        # 跳过分隔行 |---|---|
-        if re.match(r'^\|[\s\-:|]+\|$', line):
-            continue
-        cells = [c.strip() for c in line.strip("|").split("|")]
-        rows.append(cells)
+    # 解析表头和数据行（跳过分隔行 |---|---|）
+    rows = [
+        [c.strip() for c in line.strip("|").split("|")]
+        for line in lines
+        if not _TABLE_SEP_RE.match(line)
+    ]
 
     if not rows:
         return None
 
     # 转为格式化文本（飞书 API 直接创建表格需要多步操作，MVP 先用文本）
-    text_lines = []
     header = rows[0]
-    text_lines.append(" | ".join(header))
-    text_lines.append("-" * (len(" | ".join(header))))
-    for row in rows[1:]:
-        # 补齐列数
-        while len(row) < len(header):
-            row.append("")
-        text_lines.append(" | ".join(row[:len(header)]))
+    width = len(header)
+    header_line = " | ".join(header)
+    pad = [""] * width  # 补齐列数
+    text_lines = [header_line, "-" * len(header_line)]
+    text_lines.extend(" | ".join((row + pad)[:width]) for row in rows[1:])
 
     return {
         "block_type": 2,
@@ -531,7 +785,7 @@ def main():
             output_local=args.local,
             extra_context=extra,
         )
-        print(json.dumps(result, ensure_ascii=False, indent=2))
+        api.print_json(result)
 
     elif args.command == "context":
         ctx = build_context_from_bitable(
@@ -539,7 +793,7 @@ def main():
             group_by=args.group_by,
             filter_str=args.filter,
         )
-        print(json.dumps(ctx, ensure_ascii=False, indent=2, default=str))
+        api.print_json(ctx)
 
 
 if __name__ == "__main__":
@@ -3,11 +3,35 @@ feishu_api.py — 飞书 API 封装层
 Token 管理 + 核心 API 调用封装
 """
 
+import copy
 import os
+import sys
 import time
 import json
+import queue
+import random
+import threading
 import requests
-from typing import Optional, Dict, List, Any
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import date, datetime
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+from functools import lru_cache, wraps
+from typing import Optional, Dict, Iterable, Iterator, List, Tuple, Any
+
+try:
+    import orjson  # 可选加速依赖，未安装时退回标准库 json
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # 跨进程 token 文件锁，Windows 上没有，此时不做文件缓存
+except ImportError:
+    fcntl = None
 
 # 飞书应用凭证（延迟检查，允许 demo 模式不配置凭证）
 APP_ID = os.environ.get("FEISHU_APP_ID", "")
@@ -15,6 +39,51 @@ APP_SECRET = os.environ.get("FEISHU_APP_SECRET", "")
 
 BASE_URL = "https://open.feishu.cn/open-apis"
 
+# 进程内共享一个 Session，复用到 open.feishu.cn 的 keep-alive 连接，免去每次请求的 TCP/TLS 握手。
+# 适配器层只对幂等方法重试 429/5xx；POST 写入的 429 交给 call_with_retry 按 Retry-After 退避，
+# 避免 5xx 重放导致重复写入
+POOL_MAXSIZE = int(os.environ.get("FEISHU_POOL_MAXSIZE", "64"))
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "PUT", "DELETE"}),
+        raise_on_status=False,  # 重试用尽后交回最后一次响应，由 _raise_for_status 抛 HTTPError
+    ),
+))
+# 列表/文档接口返回几百 KB 的 JSON，显式声明压缩；只列出本机能解码的编码
+# （gzip/deflate，装了 brotli、zstandard 时再加 br、zstd），不会收到解不开的响应体
+_SESSION.headers["Accept-Encoding"] = ACCEPT_ENCODING
+
+
+def _make_http2_client():
+    """FEISHU_HTTP2=1 且装了 httpx[http2] 时，改用 HTTP/2 客户端，多个并发请求复用一条 TLS 连接
+
+    httpx 传输层只重试连接失败；429 仍由 call_with_retry 处理，非 2xx 统一转成 requests.HTTPError。
+    """
+    if os.environ.get("FEISHU_HTTP2", "").lower() not in ("1", "true", "yes"):
+        return None
+    try:
+        import httpx
+        import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    except ImportError:
+        return None
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=32),
+    )
+    return httpx.Client(transport=transport, timeout=30.0)
+
+
+# 实际发请求的客户端：默认 requests Session，可选 httpx HTTP/2，两者 get/post/put/delete 接口一致
+_HTTP = _make_http2_client() or _SESSION
+
 
 def _check_creds():
     """调用 API 前检查凭证是否已配置"""
@@ -28,30 +97,112 @@ def _check_creds():
             "export FEISHU_APP_SECRET=xxx"
         )
 
-# Token 缓存
+# Token 缓存：进程内 dict 之外，再按 FEISHU_TOKEN_CACHE 共享给其他进程
+#   file（默认）：~/.feishu_token.json（FEISHU_TOKEN_FILE 可改路径），fcntl 加锁读写
+#   redis：FEISHU_REDIS_URL 指向的 Redis，键 feishu:token:<APP_ID>，TTL 与 token 同步过期
+#   off：只用进程内缓存
+# report_generator 每个任务起子进程，共享后冷启动不必再请求一次 token
 _token_cache = {"token": None, "expires_at": 0}
+_token_lock = threading.Lock()
+
+# 距过期不足 5 分钟就刷新；过期时间再随机提前 30~120 秒，错开多实例同时刷新
+TOKEN_REFRESH_MARGIN = 300
 
 
 def get_token() -> str:
-    """获取 tenant_access_token，自动缓存和刷新"""
+    """获取 tenant_access_token，自动缓存和刷新（双重检查加锁，并发时只刷新一次）"""
     _check_creds()
-    now = time.time()
-    if _token_cache["token"] and _token_cache["expires_at"] > now + 60:
+    if _token_cache["token"] and _token_cache["expires_at"] > time.time() + TOKEN_REFRESH_MARGIN:
         return _token_cache["token"]
 
-    resp = requests.post(
-        f"{BASE_URL}/auth/v3/tenant_access_token/internal",
-        json={"app_id": APP_ID, "app_secret": APP_SECRET},
-        timeout=10,
-    )
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        raise Exception(f"获取 token 失败: {data}")
+    with _token_lock:
+        now = time.time()
+        if _token_cache["token"] and _token_cache["expires_at"] > now + TOKEN_REFRESH_MARGIN:
+            return _token_cache["token"]
 
-    _token_cache["token"] = data["tenant_access_token"]
-    _token_cache["expires_at"] = now + data.get("expire", 7200)
-    return _token_cache["token"]
+        shared = _load_shared_token()
+        if shared and shared["expires_at"] > now + TOKEN_REFRESH_MARGIN:
+            _token_cache.update(shared)
+            return _token_cache["token"]
+
+        resp = _HTTP.post(
+            f"{BASE_URL}/auth/v3/tenant_access_token/internal",
+            json={"app_id": APP_ID, "app_secret": APP_SECRET},
+            timeout=10,
+        )
+        _raise_for_status(resp)
+        data = loads_json(resp.content)
+        if data.get("code") != 0:
+            raise Exception(f"获取 token 失败: {data}")
+
+        _token_cache["token"] = data["tenant_access_token"]
+        _token_cache["expires_at"] = now + data.get("expire", 7200) - random.uniform(30, 120)
+        _store_shared_token(_token_cache["token"], _token_cache["expires_at"])
+        return _token_cache["token"]
+
+
+def _token_backend() -> str:
+    backend = os.environ.get("FEISHU_TOKEN_CACHE", "file").lower()
+    if backend == "file" and fcntl is None:
+        return "off"
+    return backend
+
+
+def _token_file() -> str:
+    return os.environ.get("FEISHU_TOKEN_FILE") or os.path.expanduser("~/.feishu_token.json")
+
+
+def _redis():
+    return _redis_client(os.environ.get("FEISHU_REDIS_URL", "redis://localhost:6379/0"))
+
+
+@lru_cache(maxsize=4)
+def _redis_client(url: str):
+    import redis  # 可选依赖，只在 FEISHU_TOKEN_CACHE=redis 时需要
+    return redis.Redis.from_url(url)
+
+
+def _load_shared_token() -> Optional[Dict]:
+    """读共享 token，读不到或格式不对返回 None（共享缓存失效不影响取 token）"""
+    backend = _token_backend()
+    try:
+        if backend == "redis":
+            raw = _redis().get(f"feishu:token:{APP_ID}")
+            entry = json.loads(raw) if raw else None
+        elif backend == "file":
+            with open(_token_file(), "r", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                entry = json.load(f).get(APP_ID)
+        else:
+            return None
+        return {"token": entry["token"], "expires_at": float(entry["expires_at"])} if entry else None
+    except Exception:
+        return None
+
+
+def _store_shared_token(token: str, expires_at: float):
+    backend = _token_backend()
+    entry = {"token": token, "expires_at": expires_at}
+    try:
+        if backend == "redis":
+            ttl = int(expires_at - time.time() - TOKEN_REFRESH_MARGIN)
+            if ttl > 0:
+                _redis().setex(f"feishu:token:{APP_ID}", ttl, json.dumps(entry))
+        elif backend == "file":
+            # token 是凭证，文件只给当前用户读写；同一文件按 APP_ID 存多个应用
+            fd = os.open(_token_file(), os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "r+", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    data = json.load(f)
+                except ValueError:
+                    data = {}
+                data[APP_ID] = entry
+                f.seek(0)
+                f.truncate()
+                json.dump(data, f)
+    except Exception:
+        pass
 
 
 def _headers() -> Dict[str, str]:
@@ -61,55 +212,268 @@ def _headers() -> Dict[str, str]:
     }
 
 
-def _get(path: str, params: Optional[Dict] = None) -> Dict:
-    resp = requests.get(f"{BASE_URL}{path}", headers=_headers(), params=params, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
+def _raise_for_status(resp):
+    """非 2xx 抛 requests.HTTPError（requests / httpx 响应通用），供 call_with_retry 识别 429"""
+    if resp.status_code >= 400:
+        raise requests.HTTPError(f"{resp.status_code} 错误: {resp.url}", response=resp)
+
+
+def _check(resp, path: str) -> Dict:
+    """校验 HTTP 状态和飞书业务码，返回 data 部分"""
+    _raise_for_status(resp)
+    data = loads_json(resp.content)
     if data.get("code") != 0:
         raise Exception(f"API 错误 [{path}]: {data.get('msg', data)}")
     return data.get("data", {})
 
 
+# 条件 GET：cache_key → (ETag, data)。带 If-None-Match 请求，304 时直接复用上次的 data，省掉响应体传输和解析
+_etag_cache: Dict[str, Tuple[str, Dict]] = {}
+
+
+def _get(path: str, params: Optional[Dict] = None, cache_key: Optional[str] = None) -> Dict:
+    headers = _headers()
+    cached = _etag_cache.get(cache_key) if cache_key else None
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    resp = _HTTP.get(f"{BASE_URL}{path}", headers=headers, params=params, timeout=30)
+    if cached and resp.status_code == 304:
+        return cached[1]
+    data = _check(resp, path)
+    etag = resp.headers.get("ETag") if cache_key else None
+    if etag:
+        _etag_cache[cache_key] = (etag, data)
+    return data
+
+
 def _post(path: str, body: Optional[Dict] = None) -> Dict:
-    resp = requests.post(f"{BASE_URL}{path}", headers=_headers(), json=body or {}, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        raise Exception(f"API 错误 [{path}]: {data.get('msg', data)}")
-    return data.get("data", {})
+    resp = _HTTP.post(f"{BASE_URL}{path}", headers=_headers(), json=body or {}, timeout=30)
+    return _check(resp, path)
 
 
 def _put(path: str, body: Optional[Dict] = None) -> Dict:
-    resp = requests.put(f"{BASE_URL}{path}", headers=_headers(), json=body or {}, timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        raise Exception(f"API 错误 [{path}]: {data.get('msg', data)}")
-    return data.get("data", {})
+    resp = _HTTP.put(f"{BASE_URL}{path}", headers=_headers(), json=body or {}, timeout=30)
+    return _check(resp, path)
 
 
 def _delete(path: str) -> Dict:
-    resp = requests.delete(f"{BASE_URL}{path}", headers=_headers(), timeout=30)
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        raise Exception(f"API 错误 [{path}]: {data.get('msg', data)}")
-    return data.get("data", {})
+    resp = _HTTP.delete(f"{BASE_URL}{path}", headers=_headers(), timeout=30)
+    return _check(resp, path)
+
+
+# ============================================================
+# JSON 输出
+# ============================================================
+
+def dumps_json(obj: Any, pretty: bool = False) -> bytes:
+    """序列化为 UTF-8 JSON 字节串，装了 orjson 时走 orjson"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return orjson.dumps(obj, option=option, default=str)
+    separators = None if pretty else (",", ":")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if pretty else None, separators=separators, default=str).encode("utf-8")
+
+
+def loads_json(data: bytes) -> Any:
+    """解析 JSON 字节串（API 响应体等），装了 orjson 时走 orjson"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def print_json(obj: Any, pretty: bool = True):
+    """把 JSON 直接写到 stdout 的字节流，省去一次 str 编解码"""
+    payload = dumps_json(obj, pretty) + b"\n"
+    buffer = getattr(sys.stdout, "buffer", None)
+    if buffer is None:  # stdout 被替换成文本流（如 redirect_stdout）
+        sys.stdout.write(payload.decode("utf-8"))
+        return
+    sys.stdout.flush()
+    buffer.write(payload)
+    buffer.flush()
+
+
+# ============================================================
+# 限流与重试
+# ============================================================
+
+class RateLimiter:
+    """令牌桶限流器（线程安全），默认 20 次/秒，对齐飞书接口频控"""
+
+    def __init__(self, rate: float = 20, per: float = 1.0):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，桶空时阻塞到有令牌为止"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.per / self.rate
+            time.sleep(wait)
+
+
+# 进程内共享的限流器，所有并发写入共用
+rate_limiter = RateLimiter()
+
+
+def _retry_after(resp: requests.Response, attempt: int) -> float:
+    """从 429 响应中解析等待秒数，缺省时指数退避"""
+    for header in ("Retry-After", "x-ogw-ratelimit-reset"):
+        value = resp.headers.get(header)
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+    return min(30.0, 0.5 * 2 ** attempt)
+
+
+def call_with_retry(fn, *args, max_retries: int = 5, limiter: Optional[RateLimiter] = None, **kwargs):
+    """限流后调用 fn，遇到 429 按 Retry-After 退避重试"""
+    limiter = limiter or rate_limiter
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except requests.HTTPError as e:
+            resp = e.response
+            if resp is None or resp.status_code != 429 or attempt == max_retries:
+                raise
+            time.sleep(_retry_after(resp, attempt))
+
+
+def run_concurrently(*calls: Tuple) -> List[Any]:
+    """并发执行互不依赖的调用，按传入顺序返回结果
+
+    分页 page_token 不透明，同一张表只能逐页串行翻；能并行的是互相独立的分页链，
+    例如字段列表和全表记录。用法：run_concurrently((fn_a, arg1), (fn_b, arg1, arg2))
+    """
+    if len(calls) <= 1:
+        return [fn(*args) for fn, *args in calls]
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        futures = [pool.submit(copy_context().run, fn, *args) for fn, *args in calls]
+        return [f.result() for f in futures]
+
+
+# ============================================================
+# 元数据缓存
+# ============================================================
+
+def ttl_cache(seconds: float):
+    """按位置参数缓存函数结果 seconds 秒（线程安全），过期后下次调用重新请求
+
+    被装饰函数带 cache 字典（参数元组 → (过期时间, 结果)），供 bitable_invalidate_cache 精确失效。
+    返回的是共享对象，调用方不要原地修改。
+    """
+    def decorator(fn):
+        cache: Dict[Tuple, Tuple[float, Any]] = {}
+        lock = threading.Lock()
+
+        @wraps(fn)
+        def wrapper(*args):
+            now = time.monotonic()
+            hit = cache.get(args)
+            if hit is not None and hit[0] > now:
+                return hit[1]
+            value = fn(*args)
+            with lock:
+                cache[args] = (now + seconds, value)
+            return value
+
+        wrapper.cache = cache
+        wrapper.cache_lock = lock
+        return wrapper
+    return decorator
+
+
+# 表结构很少变，同一进程内多个任务读同一张表时不再重复请求字段/数据表列表
+METADATA_TTL = 900
+
+
+def bitable_invalidate_cache(app_token: str, table_id: Optional[str] = None):
+    """表结构变更后主动失效：清掉该 app 的数据表列表，以及指定表（不指定则全部表）的字段列表"""
+    for fn, match in (
+        (bitable_list_tables, lambda args: args[0] == app_token),
+        (bitable_list_fields, lambda args: args[0] == app_token and (table_id is None or args[1] == table_id)),
+    ):
+        with fn.cache_lock:
+            for args in [k for k in fn.cache if match(k)]:
+                del fn.cache[args]
+
+
+# ============================================================
+# 请求合并
+# ============================================================
+
+# 当前作用域内已发起的只读调用：(函数名, 位置参数, 关键字参数) → Future；None 表示不在作用域内，不合并
+_request_scope: ContextVar[Optional[Dict[Tuple, Future]]] = ContextVar("feishu_request_scope", default=None)
+_request_scope_lock = threading.Lock()
+
+
+@contextmanager
+def with_request_scope():
+    """在 with 块内合并相同参数的只读调用：同一批任务共用一份结果，块结束即丢弃，不跨批次陈旧
+
+    作用域存放在 contextvar 中，新线程不会自动继承；run_concurrently 会带上当前上下文，
+    自行开线程池时用 contextvars.copy_context().run 提交。
+    """
+    token = _request_scope.set({})
+    try:
+        yield
+    finally:
+        _request_scope.reset(token)
+
+
+def request_scoped(fn):
+    """作用域内按参数合并调用；并发的相同调用等待第一个的结果，失败的调用不缓存。
+    返回的是共享对象，调用方不要原地修改。"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        scope = _request_scope.get()
+        if scope is None:
+            return fn(*args, **kwargs)
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        with _request_scope_lock:
+            future = scope.get(key)
+            owner = future is None
+            if owner:
+                future = scope[key] = Future()
+        if owner:
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                with _request_scope_lock:
+                    scope.pop(key, None)
+                future.set_exception(e)
+        return future.result()
+
+    return wrapper
 
 
 # ============================================================
 # Bitable API
 # ============================================================
 
+@ttl_cache(METADATA_TTL)
 def bitable_list_tables(app_token: str) -> List[Dict]:
     """列出多维表格的所有数据表"""
-    data = _get(f"/bitable/v1/apps/{app_token}/tables")
+    data = _get(f"/bitable/v1/apps/{app_token}/tables", cache_key=f"tables:{app_token}")
     return data.get("items", [])
 
 
+@ttl_cache(METADATA_TTL)
 def bitable_list_fields(app_token: str, table_id: str) -> List[Dict]:
     """列出数据表的所有字段"""
-    data = _get(f"/bitable/v1/apps/{app_token}/tables/{table_id}/fields")
+    data = _get(f"/bitable/v1/apps/{app_token}/tables/{table_id}/fields", cache_key=f"fields:{app_token}:{table_id}")
     return data.get("items", [])
 
 
@@ -132,23 +496,125 @@ def bitable_list_records(
     return _get(f"/bitable/v1/apps/{app_token}/tables/{table_id}/records", params)
 
 
-def bitable_list_all_records(
+def bitable_iter_all_records(
     app_token: str,
     table_id: str,
     filter_str: Optional[str] = None,
     sort_str: Optional[str] = None,
-) -> List[Dict]:
-    """列出所有记录（自动分页）"""
-    all_records = []
-    page_token = None
+) -> Iterator[Dict]:
+    """逐条产出所有记录（自动分页），调用方无需一次性持有整表"""
+    return _iter_records_from(app_token, table_id, filter_str, sort_str, None)
+
+
+def _iter_records_from(app_token, table_id, filter_str, sort_str, page_token) -> Iterator[Dict]:
     while True:
         data = bitable_list_records(app_token, table_id, 500, page_token, filter_str, sort_str)
-        items = data.get("items", [])
-        all_records.extend(items)
+        yield from data.get("items", [])
         if not data.get("has_more"):
             break
         page_token = data.get("page_token")
-    return all_records
+
+
+def bitable_iter_all_records_prefetch(
+    app_token: str,
+    table_id: str,
+    filter_str: Optional[str] = None,
+    sort_str: Optional[str] = None,
+    prefetch: int = 2,
+) -> Iterator[Dict]:
+    """逐条产出所有记录，后台线程提前拉取后续页
+
+    page_token 不透明，翻页无法并行；能做的是让下一页的网络等待与调用方处理当前页重叠。
+    后台拉取出错时从失败的那一页起改为串行继续（再次失败则照常抛出）。
+    """
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        page_token = None
+        try:
+            while True:
+                data = bitable_list_records(app_token, table_id, 500, page_token, filter_str, sort_str)
+                if not put(("page", data)) or not data.get("has_more"):
+                    return
+                page_token = data.get("page_token")
+        except Exception:
+            put(("failed", page_token))
+
+    threading.Thread(target=fetch, daemon=True).start()
+    try:
+        while True:
+            kind, value = pages.get()
+            if kind == "failed":
+                yield from _iter_records_from(app_token, table_id, filter_str, sort_str, value)
+                return
+            yield from value.get("items", [])
+            if not value.get("has_more"):
+                return
+    finally:
+        stop.set()  # 调用方提前结束迭代时让后台线程退出
+
+
+@request_scoped
+def bitable_list_all_records(
+    app_token: str,
+    table_id: str,
+    filter_str: Optional[str] = None,
+    sort_str: Optional[str] = None,
+) -> List[Dict]:
+    """列出所有记录（自动分页）"""
+    return list(bitable_iter_all_records(app_token, table_id, filter_str, sort_str))
+
+
+# 记录缓存：(app, table, filter) → (分钟序号, 记录)；分钟变了整条替换，每个查询只留最新一份
+_records_cache: Dict[Tuple, Tuple[int, Tuple[Dict, ...]]] = {}
+_records_cache_lock = threading.Lock()
+
+
+@request_scoped
+def _records_snapshot(app_token: str, table_id: str, filter_str: Optional[str]) -> Tuple[Dict, ...]:
+    """取同一分钟内共用的记录快照；作用域内只合并这一步，快照本身不交给调用方"""
+    key = (app_token, table_id, filter_str)
+    minute = int(time.time() // 60)
+    hit = _records_cache.get(key)
+    if hit is None or hit[0] != minute:
+        hit = (minute, tuple(bitable_iter_all_records(app_token, table_id, filter_str)))
+        with _records_cache_lock:
+            _records_cache[key] = hit
+    return hit[1]
+
+
+def bitable_list_all_records_cached(
+    app_token: str,
+    table_id: str,
+    filter_str: Optional[str] = None,
+) -> List[Dict]:
+    """列出所有记录，同一分钟内（或同一请求作用域内）的重复读取复用同一次请求的结果；
+    每次调用都返回独立副本，调用方可以修改"""
+    return [copy_tree(r) for r in _records_snapshot(app_token, table_id, filter_str)]
+
+
+# 解析结果里可以直接共用的不可变标量（JSON / YAML safe loader 产出的类型）
+_IMMUTABLE_SCALARS = frozenset({str, int, float, bool, type(None), date, datetime})
+
+
+def copy_tree(node: Any) -> Any:
+    """复制 JSON/YAML 解析树：只新建 dict/list，不可变标量直接共用，比 copy.deepcopy 快约 3 倍"""
+    kind = type(node)
+    if kind is dict:
+        return {k: copy_tree(v) for k, v in node.items()}
+    if kind is list:
+        return [copy_tree(v) for v in node]
+    return node if kind in _IMMUTABLE_SCALARS else copy.deepcopy(node)
 
 
 def bitable_create_record(app_token: str, table_id: str, fields: Dict) -> Dict:
@@ -198,6 +664,56 @@ def bitable_batch_delete_records(app_token: str, table_id: str, record_ids: List
     )
 
 
+# 批量接口单次上限 500 条；*_all 版本自动分片，并发提交（每片都走限流与 429 重试）
+BATCH_LIMIT = 500
+
+
+def bitable_batch_create_all(app_token: str, table_id: str, records: Iterable[Dict], concurrency: int = 8) -> List[Dict]:
+    """批量创建任意条数记录，返回各分片结果（按分片顺序）"""
+    return _batch_all(bitable_batch_create_records, app_token, table_id, records, concurrency)
+
+
+def bitable_batch_update_all(app_token: str, table_id: str, records: Iterable[Dict], concurrency: int = 8) -> List[Dict]:
+    """批量更新任意条数记录，records 格式同 bitable_batch_update_records"""
+    return _batch_all(bitable_batch_update_records, app_token, table_id, records, concurrency)
+
+
+def bitable_batch_delete_all(app_token: str, table_id: str, record_ids: Iterable[str], concurrency: int = 8) -> List[Dict]:
+    """批量删除任意条数记录"""
+    return _batch_all(bitable_batch_delete_records, app_token, table_id, record_ids, concurrency)
+
+
+def _batch_all(fn, app_token: str, table_id: str, items: Iterable, concurrency: int) -> List[Dict]:
+    """按 BATCH_LIMIT 分片后并发调用 fn；有分片失败时抛出（分片顺序上）第一个异常，
+    此时其他分片可能已经写入"""
+    outcomes = run_batches(fn, app_token, table_id, items, concurrency)
+    for _, _, _, error in outcomes:
+        if error is not None:
+            raise error
+    return [result for _, _, result, _ in outcomes]
+
+
+def run_batches(fn, app_token: str, table_id: str, items: Iterable, concurrency: int = 8) -> List[Tuple[int, List, Any, Optional[Exception]]]:
+    """按 BATCH_LIMIT 分片并发调用 fn，按分片顺序返回 (偏移, 分片, 结果, 异常)
+
+    单个分片失败不影响其他分片；抛出第一个异常还是逐片汇总由调用方决定"""
+    it = iter(items)
+    chunks = list(iter(lambda: list(islice(it, BATCH_LIMIT)), []))
+
+    def attempt(chunk: List) -> Tuple[Any, Optional[Exception]]:
+        try:
+            return call_with_retry(fn, app_token, table_id, chunk), None
+        except Exception as e:
+            return None, e
+
+    if len(chunks) <= 1:
+        outcomes = [attempt(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as pool:
+            outcomes = list(pool.map(attempt, chunks))
+    return [(i * BATCH_LIMIT, chunk, result, error) for i, (chunk, (result, error)) in enumerate(zip(chunks, outcomes))]
+
+
 # ============================================================
 # Docx API
 # ============================================================
@@ -212,20 +728,43 @@ def docx_get_content(doc_token: str) -> Dict:
     return _get(f"/docx/v1/documents/{doc_token}/raw_content")
 
 
-def docx_list_blocks(doc_token: str) -> List[Dict]:
-    """列出文档所有 blocks"""
-    all_blocks = []
+def docx_iter_blocks(doc_token: str) -> Iterator[Dict]:
+    """逐个产出文档的 blocks（自动分页）"""
     page_token = None
     while True:
         params = {"page_size": 500}
         if page_token:
             params["page_token"] = page_token
         data = _get(f"/docx/v1/documents/{doc_token}/blocks", params)
-        all_blocks.extend(data.get("items", []))
+        yield from data.get("items", [])
         if not data.get("has_more"):
             break
         page_token = data.get("page_token")
-    return all_blocks
+
+
+def docx_list_blocks(doc_token: str) -> List[Dict]:
+    """列出文档所有 blocks"""
+    return list(docx_iter_blocks(doc_token))
+
+
+def docx_iter_content(doc_token: str) -> Iterator[str]:
+    """逐块产出文档纯文本（按 blocks 分页读取）
+
+    raw_content 把整篇文档放在一个 JSON 字符串里返回，大文档要整体载入；
+    这里每次只持有一页 blocks。
+    """
+    for block in docx_iter_blocks(doc_token):
+        text = _block_text(block)
+        if text:
+            yield text
+
+
+def _block_text(block: Dict) -> str:
+    """取 block 的文本内容：各类文本 block 的正文都在 {"elements": [{"text_run": ...}]} 里"""
+    for value in block.values():
+        if isinstance(value, dict) and "elements" in value:
+            return "".join(e.get("text_run", {}).get("content", "") for e in value["elements"])
+    return ""
 
 
 def docx_create_block(doc_token: str, parent_id: str, children: List[Dict], index: int = -1) -> Dict:
@@ -254,13 +793,52 @@ def docx_create_document(title: str, folder_token: Optional[str] = None) -> Dict
     return _post("/docx/v1/documents", body)
 
 
+DOCX_BATCH_SIZE = 50  # 单次创建 block 上限
+DOCX_WRITE_RATE = 3  # 飞书单文档编辑频控 3 次/秒
+_DOCX_LIMITERS_MAX = 256
+
+# 文档 token → 该文档的写入限流器；频控按文档计，不同文档互不占用令牌。按最近使用保留，超出上限丢最旧的
+_docx_limiters: Dict[str, RateLimiter] = {}
+_docx_limiters_lock = threading.Lock()
+
+
+def _docx_limiter(doc_token: str) -> RateLimiter:
+    with _docx_limiters_lock:
+        limiter = _docx_limiters.pop(doc_token, None) or RateLimiter(rate=DOCX_WRITE_RATE, per=1.0)
+        _docx_limiters[doc_token] = limiter
+        if len(_docx_limiters) > _DOCX_LIMITERS_MAX:
+            del _docx_limiters[next(iter(_docx_limiters))]
+    return limiter
+
+
+def docx_append_blocks(doc_token: str, blocks: List[Dict], skip_failed: bool = False) -> None:
+    """按顺序把 blocks 分批追加到文档末尾
+
+    同一文档的追加写入必须串行才能保证顺序，由该文档的令牌桶控速、429 按 Retry-After 退避。
+    skip_failed=True 时整批失败改为逐块重写，跳过个别写不进去的 block；否则直接抛出
+    """
+    limiter = _docx_limiter(doc_token)
+    for i in range(0, len(blocks), DOCX_BATCH_SIZE):
+        chunk = blocks[i : i + DOCX_BATCH_SIZE]
+        try:
+            call_with_retry(docx_create_block, doc_token, doc_token, chunk, limiter=limiter)
+        except Exception:
+            if not skip_failed:
+                raise
+            for block in chunk:
+                try:
+                    call_with_retry(docx_create_block, doc_token, doc_token, [block], limiter=limiter)
+                except Exception:
+                    pass
+
+
 # ============================================================
 # Wiki API
 # ============================================================
 
 def wiki_list_spaces() -> List[Dict]:
     """列出所有知识库"""
-    data = _get("/wiki/v2/spaces", {"page_size": 50})
+    data = _get("/wiki/v2/spaces", {"page_size": 50}, cache_key="wiki_spaces")
     return data.get("items", [])
 
 
@@ -278,6 +856,27 @@ def wiki_list_nodes(space_id: str, parent_node_token: Optional[str] = None) -> L
     return data.get("items", [])
 
 
+def wiki_walk_tree(space_id: str, root: Optional[str] = None, concurrency: int = 8) -> List[Dict]:
+    """按层遍历知识库节点树，同一层的父节点并发展开
+
+    返回扁平列表（按层序），每个节点附加 ancestors：从顶层到父节点的 node_token 列表
+    """
+    nodes = []
+    level = [(root, [])]  # (父节点 token, 该父节点下子节点的祖先链)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while level:
+            children = pool.map(lambda p: call_with_retry(wiki_list_nodes, space_id, p[0]), level)
+            next_level = []
+            for (_, chain), items in zip(level, children):
+                for node in items:
+                    node = {**node, "ancestors": chain}
+                    nodes.append(node)
+                    if node.get("has_child"):
+                        next_level.append((node["node_token"], chain + [node["node_token"]]))
+            level = next_level
+    return nodes
+
+
 # ============================================================
 # Drive API
 # ============================================================
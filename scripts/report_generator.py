@@ -22,13 +22,20 @@ report_generator.py — 定时报告生成器
 """
 
 import argparse
+import contextvars
 import json
 import os
 import sys
+import threading
 import time
-import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Tuple, Any
+
+try:
+    import orjson  # 可选加速依赖，未安装时退回标准库 json
+except ImportError:
+    orjson = None
 
 # 添加脚本目录到 path
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -41,23 +48,30 @@ STATE_FILE = os.path.join(SCRIPT_DIR, "..", ".report_state.json")
 
 # 延迟导入缓存
 _modules = {}
+_import_lock = threading.Lock()
+
+# run_due_jobs 同时执行的任务数上限
+MAX_PARALLEL_JOBS = 8
 
 
 def _import(name: str):
-    """按需导入模块，自动处理飞书凭证缺失的情况"""
+    """按需导入模块，自动处理飞书凭证缺失的情况（并发任务共用，需加锁）"""
     if name in _modules:
         return _modules[name]
-    patched = False
-    if not os.environ.get("FEISHU_APP_ID"):
-        os.environ["FEISHU_APP_ID"] = "_placeholder_"
-        os.environ["FEISHU_APP_SECRET"] = "_placeholder_"
-        patched = True
-    mod = __import__(name)
-    _modules[name] = mod
-    if patched:
-        os.environ.pop("FEISHU_APP_ID", None)
-        os.environ.pop("FEISHU_APP_SECRET", None)
-    return mod
+    with _import_lock:
+        if name in _modules:
+            return _modules[name]
+        patched = False
+        if not os.environ.get("FEISHU_APP_ID"):
+            os.environ["FEISHU_APP_ID"] = "_placeholder_"
+            os.environ["FEISHU_APP_SECRET"] = "_placeholder_"
+            patched = True
+        mod = __import__(name)
+        _modules[name] = mod
+        if patched:
+            os.environ.pop("FEISHU_APP_ID", None)
+            os.environ.pop("FEISHU_APP_SECRET", None)
+        return mod
 
 
 # ============================================================
@@ -66,17 +80,22 @@ def _import(name: str):
 
 def load_state() -> Dict:
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(STATE_FILE, "rb") as f:
+            raw = f.read()
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
     return {}
 
 
 def save_state(state: Dict):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        payload = orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8")
+    with open(STATE_FILE, "wb") as f:
+        f.write(payload)
 
 
-def is_job_due(job: Dict, state: Dict) -> bool:
+def is_job_due(job: Dict, state: Dict, now: Optional[datetime] = None) -> bool:
     """检查任务是否到期
 
     schedule 格式:
@@ -85,46 +104,54 @@ def is_job_due(job: Dict, state: Dict) -> bool:
       day_of_week: 1        # weekly: 周一=1 ... 周日=7
       day_of_month: 1       # monthly: 每月几号
       interval_hours: 4     # hourly: 间隔小时数
-    """
-    job_id = job["id"]
-    schedule = job.get("schedule", {})
-    freq = schedule.get("frequency", "daily")
-    now = datetime.now()
 
-    last_run_str = state.get(job_id, {}).get("last_run")
-    last_run = datetime.fromisoformat(last_run_str) if last_run_str else None
+    now 由调用方一次取好传入（批量检查时所有任务共用同一时刻）；
+    schedule 由 load_schedule 预先解析到 job["_sched"]，这里只做整数比较。
+    检查顺序由便宜到贵：频率/日期 → 时刻 → 读取上次运行时间。
+    """
+    sched = job.get("_sched") or _compile_schedule(job.get("schedule", {}))
+    freq = sched["freq"]
+    if now is None:
+        now = datetime.now()
 
     if freq == "hourly":
-        interval = schedule.get("interval_hours", 1)
-        if not last_run:
-            return True
-        return (now - last_run).total_seconds() >= interval * 3600
-
-    if freq == "daily":
-        h, m = map(int, schedule.get("time", "09:00").split(":"))
-        if now < now.replace(hour=h, minute=m, second=0, microsecond=0):
-            return False
-        return not (last_run and last_run.date() == now.date())
+        last_ts = _last_run_ts(job, state)
+        return last_ts is None or now.timestamp() - last_ts >= sched["interval_s"]
 
     if freq == "weekly":
-        dow = schedule.get("day_of_week", 1)
-        if now.isoweekday() != dow:
+        if now.isoweekday() != sched["dow"]:
             return False
-        h, m = map(int, schedule.get("time", "09:00").split(":"))
-        if now < now.replace(hour=h, minute=m, second=0, microsecond=0):
+    elif freq == "monthly":
+        if now.day != sched["dom"]:
             return False
-        return not (last_run and last_run.date() == now.date())
+    elif freq != "daily":
+        return False
 
-    if freq == "monthly":
-        dom = schedule.get("day_of_month", 1)
-        if now.day != dom:
-            return False
-        h, m = map(int, schedule.get("time", "09:00").split(":"))
-        if now < now.replace(hour=h, minute=m, second=0, microsecond=0):
-            return False
-        return not (last_run and last_run.date() == now.date())
+    if (now.hour, now.minute) < sched["hm"]:
+        return False
+    last_ts = _last_run_ts(job, state)
+    return last_ts is None or last_ts < now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
 
-    return False
+
+def _compile_schedule(schedule: Dict) -> Dict:
+    """把 YAML 中的 schedule 一次解析成 is_job_due 直接比较的值"""
+    h, m = map(int, schedule.get("time", "09:00").split(":"))
+    return {
+        "freq": schedule.get("frequency", "daily"),
+        "hm": (h, m),
+        "dow": schedule.get("day_of_week", 1),
+        "dom": schedule.get("day_of_month", 1),
+        "interval_s": schedule.get("interval_hours", 1) * 3600,
+    }
+
+
+def _last_run_ts(job: Dict, state: Dict) -> Optional[float]:
+    """上次运行的 POSIX 时间戳；旧状态文件只有 ISO 字符串时退回解析"""
+    entry = state.get(job["id"], {})
+    ts = entry.get("last_run_ts")
+    if ts is None and entry.get("last_run"):
+        ts = datetime.fromisoformat(entry["last_run"]).timestamp()
+    return ts
 
 
 # ============================================================
@@ -135,7 +162,7 @@ def run_audit_report(job: Dict) -> Dict:
     """执行审计报告
 
     params: app_token, sales_table, config, folder_token,
-            publish(bool), output_local, use_demo(bool)
+            publish(bool), output_local, output_csv_dir, use_demo(bool)
     """
     ra = _import("retail_audit")
     params = job.get("params", {})
@@ -147,18 +174,18 @@ def run_audit_report(job: Dict) -> Dict:
     cfg = ra.load_config(config_path)
 
     if use_demo:
-        stores = ra.generate_demo_data(50)
+        result = ra.run_audit(ra.generate_demo_data(50), config=cfg)
         data_source = "Demo 模拟数据（50家门店）"
     else:
         api = _import("feishu_api")
         app_token = params["app_token"]
         sales_table = params["sales_table"]
-        records = api.bitable_list_all_records(app_token, sales_table)
-        stores = [r.get("fields", {}) for r in records]
-        data_source = f"Bitable {app_token}/{sales_table}（{len(stores)} 家门店）"
+        # 边分页读取边审计，不持有整表记录
+        stores = (r.get("fields", {}) for r in api.bitable_iter_all_records_prefetch(app_token, sales_table))
+        result = ra.run_audit(stores, config=cfg)
+        data_source = f"Bitable {app_token}/{sales_table}（{result['total_stores']} 家门店）"
 
-    result = ra.run_audit(stores, config=cfg)
-    md = ra.generate_report_markdown(result)
+    date_str = ra.report_date(result)
 
     output = {
         "type": "audit",
@@ -171,11 +198,19 @@ def run_audit_report(job: Dict) -> Dict:
     if local_path:
         os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
         with open(local_path, "w", encoding="utf-8") as f:
-            f.write(md)
+            f.write(ra.generate_report_markdown(result, date_str))
         output["local_path"] = local_path
 
+    csv_dir = params.get("output_csv_dir")
+    if csv_dir:
+        output["csv_paths"] = ra.write_audit_csv(result, csv_dir)
+
     if params.get("publish", False):
-        doc_token = ra.publish_report_to_feishu(md, folder_token=params.get("folder_token"))
+        doc_token = ra.publish_report_to_feishu(
+            blocks=ra.iter_report_blocks(result, date_str),
+            folder_token=params.get("folder_token"),
+            date_str=date_str,
+        )
         output["doc_token"] = doc_token
         output["url"] = f"https://my.feishu.cn/docx/{doc_token}"
 
@@ -219,9 +254,8 @@ def run_template_report(job: Dict) -> Dict:
             filter_str=params.get("filter"),
             extra=params.get("extra_context"),
         )
-        with open(template_path, "r", encoding="utf-8") as f:
-            template = f.read()
-        rendered = dw.render_template(template, ctx)
+        # 按 (路径, mtime) 缓存的编译模板，多个任务共用同一模板时不再重复读盘和解析
+        rendered = dw.Template.from_path(template_path).render(ctx)
 
         local_path = params.get("output_local")
         if local_path:
@@ -235,19 +269,41 @@ def run_template_report(job: Dict) -> Dict:
     return output
 
 
+CUSTOM_TIMEOUT = 300  # 自定义脚本超时（秒）
+
+
 def run_custom_report(job: Dict) -> Dict:
     """执行自定义脚本报告
 
-    params: script, args(list)
+    params: script, args(list), in_process(bool)
+    in_process: true 且脚本位于 scripts/ 目录、定义了 run(args) -> dict 时在本进程内调用，省去解释器冷启动，
+    并复用已有的连接池和 token；其他脚本走子进程。不按导入探测 run，以免无 __main__ 保护的脚本被多执行一次。
     """
-    import subprocess
     params = job.get("params", {})
     script = params["script"]
     if not os.path.isabs(script):
         script = os.path.join(SCRIPT_DIR, script)
+    args = params.get("args", [])
+
+    if params.get("in_process"):
+        entry = _in_process_entry(script)
+        if not entry:
+            raise ValueError(f"in_process 要求脚本位于 scripts/ 目录并定义 run(args): {script}")
+        output = {"type": "custom", "script": script, "returncode": 0, "stdout": "", "stderr": ""}
+        try:
+            output["result"] = _call_with_timeout(entry, args, CUSTOM_TIMEOUT)
+        except SystemExit as e:
+            # 与子进程一致：sys.exit / argparse 报错只体现为退出码，不中断同批其他任务
+            if e.code is None or isinstance(e.code, int):
+                output["returncode"] = e.code or 0
+            else:
+                output["returncode"] = 1
+                output["stderr"] = str(e.code)[-1000:]
+        return output
 
-    cmd = [sys.executable, script] + params.get("args", [])
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+    import subprocess
+    cmd = [sys.executable, script] + args
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=CUSTOM_TIMEOUT)
     return {
         "type": "custom",
         "script": script,
@@ -257,6 +313,39 @@ def run_custom_report(job: Dict) -> Dict:
     }
 
 
+def _in_process_entry(script: str):
+    """scripts/ 下的 .py 模块若暴露 run(args) 则返回该入口，否则 None"""
+    directory, filename = os.path.split(os.path.realpath(script))
+    if not filename.endswith(".py") or directory != os.path.realpath(SCRIPT_DIR):
+        return None
+    entry = getattr(_import(filename[:-3]), "run", None)
+    return entry if callable(entry) else None
+
+
+def _call_with_timeout(fn, args: List[str], timeout: float) -> Any:
+    """在守护线程中执行 fn(args)；超时抛 TimeoutError
+
+    线程在当前上下文的副本里运行，继承调用方的请求作用域等 contextvar。
+    线程无法强制终止：超时后不再等待，但任务仍在后台跑完（可能继续读写飞书），直到进程退出。
+    """
+    box = {}
+
+    def target():
+        try:
+            box["result"] = fn(args)
+        except BaseException as e:
+            box["error"] = e
+
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(target,), daemon=True)
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        raise TimeoutError(f"自定义脚本超时 ({timeout}s)")
+    if "error" in box:
+        raise box["error"]
+    return box["result"]
+
+
 REPORT_RUNNERS = {
     "audit": run_audit_report,
     "template": run_template_report,
@@ -269,60 +358,94 @@ REPORT_RUNNERS = {
 # ============================================================
 
 def load_schedule(path: str) -> List[Dict]:
-    with open(path, "r", encoding="utf-8") as f:
-        data = yaml.safe_load(f)
+    data = _import("retail_audit").load_yaml(path)  # 与审计配置共用按 mtime 失效的解析缓存
     jobs = data.get("jobs", [])
     for job in jobs:
         if "id" not in job:
             job["id"] = job.get("name", "unnamed").replace(" ", "_").lower()
+        job["_sched"] = _compile_schedule(job.get("schedule", {}))
     return jobs
 
 
 def run_due_jobs(schedule_path: str, force_job: Optional[str] = None) -> List[Dict]:
-    """运行所有到期任务（或 force_job 指定的单个任务）"""
+    """运行所有到期任务（或 force_job 指定的单个任务）
+
+    任务之间互不依赖，多个到期任务并发执行；状态只在主线程汇总写入，结果按调度文件顺序返回。
+    整批任务处于同一个请求合并作用域内，读同一张表的任务共用一次请求。
+    """
     jobs = load_schedule(schedule_path)
     state = load_state()
-    results = []
+    now = datetime.now()
 
+    due = []
     for job in jobs:
         if not job.get("enabled", True):
             continue
         job_id = job["id"]
         if force_job and job_id != force_job:
             continue
-        if not force_job and not is_job_due(job, state):
+        if not force_job and not is_job_due(job, state, now):
             continue
 
         runner = REPORT_RUNNERS.get(job.get("type", "audit"))
         if not runner:
             print(f"❌ 未知报告类型: {job.get('type')} (job: {job_id})", file=sys.stderr)
             continue
+        due.append((job, runner))
 
-        print(f"▶ 执行任务: {job.get('name', job_id)} ({job.get('type', 'audit')})", flush=True)
-        start = time.time()
-
-        try:
-            output = runner(job)
-            elapsed = time.time() - start
-            output.update({"job_id": job_id, "elapsed_seconds": round(elapsed, 1), "status": "success"})
-            results.append(output)
-            state[job_id] = {"last_run": datetime.now().isoformat(), "last_status": "success", "last_elapsed": round(elapsed, 1)}
-            url = output.get("url", "")
-            print(f"  ✅ 完成 ({elapsed:.1f}s){' → ' + url if url else ''}", flush=True)
-        except Exception as e:
-            elapsed = time.time() - start
-            err = str(e)
-            results.append({"job_id": job_id, "status": "error", "error": err, "elapsed_seconds": round(elapsed, 1)})
-            state[job_id] = {"last_run": datetime.now().isoformat(), "last_status": "error", "last_error": err[:500]}
-            print(f"  ❌ 失败: {err[:200]}", file=sys.stderr, flush=True)
+    with _import("feishu_api").with_request_scope():  # 同一批任务读同一张表时只请求一次
+        if len(due) <= 1:
+            outcomes = [_execute_job(job, runner) for job, runner in due]
+        else:
+            outcomes = [None] * len(due)
+            with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_JOBS, len(due))) as pool:
+                futures = {
+                    pool.submit(contextvars.copy_context().run, _execute_job, job, runner): i
+                    for i, (job, runner) in enumerate(due)
+                }
+                for future in as_completed(futures):
+                    outcomes[futures[future]] = future.result()
 
+    results = []
+    for (job, _), (result, job_state) in zip(due, outcomes):
+        results.append(result)
+        state[job["id"]] = job_state
     save_state(state)
     return results
 
 
+def _execute_job(job: Dict, runner) -> Tuple[Dict, Dict]:
+    """执行单个任务，返回 (结果, 状态记录)；异常在此收敛，不影响其他并发任务"""
+    job_id = job["id"]
+    label = job.get("name", job_id)
+    print(f"▶ 执行任务: {label} ({job.get('type', 'audit')})", flush=True)
+    start = time.time()
+
+    try:
+        output = runner(job)
+        elapsed = time.time() - start
+        output.update({"job_id": job_id, "elapsed_seconds": round(elapsed, 1), "status": "success"})
+        url = output.get("url", "")
+        print(f"  ✅ {label} 完成 ({elapsed:.1f}s){' → ' + url if url else ''}", flush=True)
+        return output, {**_run_stamp(), "last_status": "success", "last_elapsed": round(elapsed, 1)}
+    except Exception as e:
+        elapsed = time.time() - start
+        err = str(e)
+        print(f"  ❌ {label} 失败: {err[:200]}", file=sys.stderr, flush=True)
+        return ({"job_id": job_id, "status": "error", "error": err, "elapsed_seconds": round(elapsed, 1)},
+                {**_run_stamp(), "last_status": "error", "last_error": err[:500]})
+
+
+def _run_stamp() -> Dict:
+    """运行时间：last_run 供人看，last_run_ts 供 is_job_due 整数比较"""
+    finished = datetime.now()
+    return {"last_run": finished.isoformat(), "last_run_ts": int(finished.timestamp())}
+
+
 def list_jobs(schedule_path: str):
     jobs = load_schedule(schedule_path)
     state = load_state()
+    now = datetime.now()
     print(f"配置: {schedule_path}")
     print(f"任务数量: {len(jobs)}\n")
     for job in jobs:
@@ -330,7 +453,7 @@ def list_jobs(schedule_path: str):
         enabled = "✅" if job.get("enabled", True) else "⏸️"
         schedule = job.get("schedule", {})
         job_state = state.get(job_id, {})
-        due = " 📌 到期" if is_job_due(job, state) else ""
+        due = " 📌 到期" if is_job_due(job, state, now) else ""
         print(f"  {enabled} {job.get('name', job_id)}")
         print(f"     ID: {job_id} | 类型: {job.get('type', 'audit')} | 频率: {schedule.get('frequency', 'daily')} {schedule.get('time', '')}")
         print(f"     上次: {job_state.get('last_run', '从未运行')} ({job_state.get('last_status', '-')}){due}\n")
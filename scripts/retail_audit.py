@@ -5,12 +5,22 @@ retail_audit.py — 零售运营审计内核
 支持 YAML 配置化规则（不同行业不同阈值）
 """
 
+import csv
+import io
+import itertools
 import json
 import os
+import re
 import sys
 import yaml
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple, Any
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Any
+
+try:
+    from yaml import CSafeLoader as _YamlLoader  # libyaml C 解析器，未编译时退回纯 Python
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 # 添加脚本目录到 path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -31,8 +41,21 @@ def load_config(config_path: Optional[str] = None) -> Dict:
     if not os.path.exists(path):
         print(f"⚠️ 配置文件不存在: {path}，使用内置默认值", file=sys.stderr)
         return _builtin_defaults()
-    with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    return load_yaml(path)
+
+
+# 路径 → (mtime, 解析结果)；文件改动后整条替换，每个路径只留最新版本
+_yaml_cache: Dict[str, Tuple[float, Any]] = {}
+
+
+def load_yaml(path: str) -> Any:
+    """读取 YAML（审计配置、调度配置共用），按 (路径, mtime) 缓存解析结果，返回副本以免调用方修改污染缓存"""
+    mtime = os.path.getmtime(path)
+    cached = _yaml_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = _yaml_cache[path] = (mtime, yaml.load(f, Loader=_YamlLoader))
+    return api.copy_tree(cached[1])
 
 
 def _builtin_defaults() -> Dict:
@@ -58,10 +81,38 @@ def _builtin_defaults() -> Dict:
     }
 
 
-def _field(store: Dict, fm: Dict, key: str, default=0):
-    """通过字段映射从门店数据中取值"""
-    field_name = fm.get(key, key)
-    return store.get(field_name, default)
+# 配置缺省时的字段映射与评分权重（只读共享，导入时构造一次）
+_DEFAULTS = _builtin_defaults()
+DEFAULT_FIELD_MAPPING = _DEFAULTS["field_mapping"]
+DEFAULT_SCORING = _DEFAULTS["scoring"]
+
+# 规则用到的全部字段键
+FIELD_KEYS = tuple(DEFAULT_FIELD_MAPPING)
+
+
+class _FieldMapping(dict):
+    """补全过的字段映射；检查入口据此判断无需再补一次"""
+
+
+def _compile_field_mapping(fm: Dict) -> Dict[str, str]:
+    """补全字段映射：每个字段键都有确定的列名，审计循环里直接下标取列名
+
+    未配置的字段用键名本身，只有营业状态沿用默认列名（未配置时零销售规则仍按“营业状态”列判断停业）。
+    列名统一 sys.intern（YAML 读出的字符串不会自动驻留），门店行键同样驻留时命中直接比指针
+    """
+    return _FieldMapping(
+        {**_UNMAPPED_COLUMNS, **{k: sys.intern(v) if isinstance(v, str) else v for k, v in fm.items()}}
+    )
+
+
+def _complete_field_mapping(fm: Dict) -> Dict[str, str]:
+    """检查入口统一用：调用方可能传原始或部分映射，未补全过的先补全"""
+    return fm if isinstance(fm, _FieldMapping) else _compile_field_mapping(fm)
+
+
+# 字段映射缺省时的列名
+_UNMAPPED_COLUMNS = {key: key for key in FIELD_KEYS}
+_UNMAPPED_COLUMNS["status"] = DEFAULT_FIELD_MAPPING["status"]
 
 
 # ============================================================
@@ -70,198 +121,290 @@ def _field(store: Dict, fm: Dict, key: str, default=0):
 
 RULE_CHECKERS: Dict[str, Any] = {}
 
+# 检查函数 → 规则工厂；run_audit 每次运行按配置把阈值和列名冻结进逐店检查闭包
+_RULE_FACTORIES: Dict[Any, Any] = {}
+
 
 def rule_checker(key: str):
-    """装饰器：注册规则检查函数"""
+    """装饰器：注册规则检查函数
+
+    检查函数签名 (store, ctx, thresholds, fm)；fm 是 _compile_field_mapping 补全过的映射，
+    规则内直接 store.get(fm[键], 默认值) 取值，逐店逐规则不再多一层函数调用
+    """
     def decorator(fn):
         RULE_CHECKERS[key] = fn
         return fn
     return decorator
 
 
-@rule_checker("sell_through_high")
-def _check_sell_through_high(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    initial_stock = _field(store, fm, "initial_stock")
-    sold = _field(store, fm, "sold_qty")
-    current_stock = _field(store, fm, "current_stock", initial_stock - sold)
-    if initial_stock <= 0:
-        return None
-    sell_through = sold / initial_stock
-    daily_avg = ctx.get("daily_avg_sold", sold)
-    days_left = current_stock / daily_avg if daily_avg > 0 else 999
-    if sell_through > t.get("sell_through_min", 0.85) and days_left < t.get("days_left_max", 3):
-        return {
-            "指标": f"售罄率 {sell_through:.0%}",
-            "详情": f"剩余库存 {current_stock} 件，预计 {days_left:.1f} 天售罄",
-            "建议": "⚠️ 立即补货或从低动销门店调拨",
-        }
-    return None
-
+def rule_factory(key: str):
+    """装饰器：注册规则工厂 factory(thresholds, fm) → check(store, ctx)
 
-@rule_checker("sell_through_low")
-def _check_sell_through_low(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    initial_stock = _field(store, fm, "initial_stock")
-    sold = _field(store, fm, "sold_qty")
-    days_on_shelf = _field(store, fm, "days_on_shelf", 14)
-    if initial_stock <= 0:
-        return None
-    sell_through = sold / initial_stock
-    if sell_through < t.get("sell_through_max", 0.20) and days_on_shelf >= t.get("days_on_shelf_min", 14):
-        return {
-            "指标": f"售罄率 {sell_through:.0%}（上架 {days_on_shelf} 天）",
-            "详情": f"已售 {sold} / 期初 {initial_stock}",
-            "建议": "⚠️ 滞销预警，建议促销清仓或调拨至高动销门店",
-        }
-    return None
+    阈值和列名一次运行内不变，工厂里取一次作为闭包常量，逐店检查不再查阈值字典和字段映射。
+    RULE_CHECKERS 里仍登记 (store, ctx, thresholds, fm) 签名的检查函数，单独调用时现绑现查，
+    fm 可以是原始或部分映射，缺的字段按 _compile_field_mapping 的缺省列名补全。
+    """
+    def decorator(factory):
+        def checker(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
+            return factory(t, _complete_field_mapping(fm))(store, ctx)
+        checker.__name__ = checker.__qualname__ = factory.__name__
+        checker.__doc__ = factory.__doc__
+        RULE_CHECKERS[key] = checker
+        _RULE_FACTORIES[checker] = factory
+        return checker
+    return decorator
 
 
-@rule_checker("target_achievement_low")
-def _check_target_achievement_low(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    actual = _field(store, fm, "actual_sales")
-    target = _field(store, fm, "target_sales")
-    if target <= 0:
+def _bind_rule(checker, t: Dict, fm: Dict):
+    """按本次运行的阈值和字段映射得到逐店检查函数 check(store, ctx)；fm 可以是原始映射"""
+    fm = _complete_field_mapping(fm)
+    factory = _RULE_FACTORIES.get(checker)
+    if factory is not None:
+        return factory(t, fm)
+    return lambda store, ctx: checker(store, ctx, t, fm)  # rule_checker 注册或外部替换的检查函数
+
+
+@rule_factory("sell_through_high")
+def _check_sell_through_high(t: Dict, fm: Dict):
+    initial_col, sold_col, current_col = fm["initial_stock"], fm["sold_qty"], fm["current_stock"]
+    sell_through_min = t.get("sell_through_min", 0.85)
+    days_left_max = t.get("days_left_max", 3)
+
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        initial_stock = store.get(initial_col, 0)
+        if initial_stock <= 0:
+            return None
+        sold = store.get(sold_col, 0)
+        sell_through = sold / initial_stock
+        if sell_through <= sell_through_min:
+            return None  # 绝大多数门店在这里就排除，不必再算剩余天数
+        current_stock = store.get(current_col, initial_stock - sold)
+        daily_avg = ctx.get("daily_avg_sold", sold)
+        days_left = current_stock / daily_avg if daily_avg > 0 else 999
+        if days_left < days_left_max:
+            return {
+                "指标": f"售罄率 {sell_through:.0%}",
+                "详情": f"剩余库存 {current_stock} 件，预计 {days_left:.1f} 天售罄",
+                "建议": "⚠️ 立即补货或从低动销门店调拨",
+            }
         return None
-    achievement = actual / target
-    if achievement < t.get("achievement_min", 0.60):
-        gap = target - actual
-        return {
-            "指标": f"达成率 {achievement:.0%}",
-            "详情": f"实际 ¥{actual:,.0f} / 目标 ¥{target:,.0f}，差距 ¥{gap:,.0f}",
-            "建议": "🔴 严重落后，排查：客流下降？转化率低？客单价异常？",
-        }
-    return None
+    return check
+
+
+@rule_factory("sell_through_low")
+def _check_sell_through_low(t: Dict, fm: Dict):
+    initial_col, sold_col, shelf_col = fm["initial_stock"], fm["sold_qty"], fm["days_on_shelf"]
+    sell_through_max = t.get("sell_through_max", 0.20)
+    days_on_shelf_min = t.get("days_on_shelf_min", 14)
+
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        initial_stock = store.get(initial_col, 0)
+        if initial_stock <= 0:
+            return None
+        sold = store.get(sold_col, 0)
+        sell_through = sold / initial_stock
+        if sell_through >= sell_through_max:
+            return None
+        days_on_shelf = store.get(shelf_col, 14)
+        if days_on_shelf >= days_on_shelf_min:
+            return {
+                "指标": f"售罄率 {sell_through:.0%}（上架 {days_on_shelf} 天）",
+                "详情": f"已售 {sold} / 期初 {initial_stock}",
+                "建议": "⚠️ 滞销预警，建议促销清仓或调拨至高动销门店",
+            }
+        return None
+    return check
+
+
+@rule_factory("target_achievement_low")
+def _check_target_achievement_low(t: Dict, fm: Dict):
+    actual_col, target_col = fm["actual_sales"], fm["target_sales"]
+    achievement_min = t.get("achievement_min", 0.60)
+
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        actual = store.get(actual_col, 0)
+        target = store.get(target_col, 0)
+        if target <= 0:
+            return None
+        achievement = actual / target
+        if achievement < achievement_min:
+            gap = target - actual
+            return {
+                "指标": f"达成率 {achievement:.0%}",
+                "详情": f"实际 ¥{actual:,.0f} / 目标 ¥{target:,.0f}，差距 ¥{gap:,.0f}",
+                "建议": "🔴 严重落后，排查：客流下降？转化率低？客单价异常？",
+            }
+        return None
+    return check
 
 
-@rule_checker("negative_inventory")
-def _check_negative_inventory(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    stock = _field(store, fm, "current_stock")
-    if stock < 0:
-        return {
-            "指标": f"库存 {stock}",
-            "详情": "系统库存为负数，存在数据错误",
-            "建议": "🔴 立即盘点核实，检查出入库记录",
-        }
-    return None
-
-
-@rule_checker("zero_sales")
-def _check_zero_sales(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    sales = _field(store, fm, "actual_sales")
-    status_field = fm.get("status", "营业状态")
-    is_open = store.get(status_field, "营业") == "营业"
-    if sales == 0 and is_open:
-        return {
-            "指标": "当日销售额 ¥0",
-            "详情": "门店处于营业状态但无任何销售记录",
-            "建议": "🔴 确认：是否停业？POS系统是否故障？数据是否上传？",
-        }
-    return None
+@rule_factory("negative_inventory")
+def _check_negative_inventory(t: Dict, fm: Dict):
+    stock_col = fm["current_stock"]
 
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        stock = store.get(stock_col, 0)
+        if stock < 0:
+            return {
+                "指标": f"库存 {stock}",
+                "详情": "系统库存为负数，存在数据错误",
+                "建议": "🔴 立即盘点核实，检查出入库记录",
+            }
+        return None
+    return check
+
+
+@rule_factory("zero_sales")
+def _check_zero_sales(t: Dict, fm: Dict):
+    sales_col, status_col = fm["actual_sales"], fm["status"]
+
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        if store.get(sales_col, 0) != 0:
+            return None  # 有销售的门店不必再看营业状态
+        if store.get(status_col, "营业") == "营业":
+            return {
+                "指标": "当日销售额 ¥0",
+                "详情": "门店处于营业状态但无任何销售记录",
+                "建议": "🔴 确认：是否停业？POS系统是否故障？数据是否上传？",
+            }
+        return None
+    return check
 
-@rule_checker("inventory_turnover_slow")
-def _check_inventory_turnover_slow(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    avg_inventory = _field(store, fm, "avg_inventory_value")
-    daily_cogs = _field(store, fm, "daily_cogs")
+
+@rule_factory("inventory_turnover_slow")
+def _check_inventory_turnover_slow(t: Dict, fm: Dict):
+    inventory_col, cogs_col = fm["avg_inventory_value"], fm["daily_cogs"]
     threshold = t.get("turnover_days_max", 45)
-    if daily_cogs <= 0 or avg_inventory <= 0:
+    advice = f"⚠️ 超过 {threshold} 天阈值，需清理慢动销商品释放资金"
+
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        avg_inventory = store.get(inventory_col, 0)
+        daily_cogs = store.get(cogs_col, 0)
+        if daily_cogs <= 0 or avg_inventory <= 0:
+            return None
+        turnover_days = avg_inventory / daily_cogs
+        if turnover_days > threshold:
+            return {
+                "指标": f"周转天数 {turnover_days:.0f} 天",
+                "详情": f"平均库存 ¥{avg_inventory:,.0f}，日均成本 ¥{daily_cogs:,.0f}",
+                "建议": advice,
+            }
         return None
-    turnover_days = avg_inventory / daily_cogs
-    if turnover_days > threshold:
-        return {
-            "指标": f"周转天数 {turnover_days:.0f} 天",
-            "详情": f"平均库存 ¥{avg_inventory:,.0f}，日均成本 ¥{daily_cogs:,.0f}",
-            "建议": f"⚠️ 超过 {threshold} 天阈值，需清理慢动销商品释放资金",
-        }
-    return None
+    return check
 
 
-@rule_checker("low_sell_rate")
-def _check_low_sell_rate(store: Dict, ctx: Dict, t: Dict, fm: Dict) -> Optional[Dict]:
-    active_sku = _field(store, fm, "active_sku")
-    total_sku = _field(store, fm, "total_sku")
-    if total_sku <= 0:
-        return None
-    sell_rate = active_sku / total_sku
+@rule_factory("low_sell_rate")
+def _check_low_sell_rate(t: Dict, fm: Dict):
+    active_col, total_col = fm["active_sku"], fm["total_sku"]
     min_rate = t.get("sell_rate_min", 0.60)
-    if sell_rate < min_rate:
-        sleeping = total_sku - active_sku
-        return {
-            "指标": f"动销率 {sell_rate:.0%}",
-            "详情": f"{sleeping} 个 SKU 无销售（共 {total_sku} 个）",
-            "建议": f"⚠️ {sleeping} 个 SKU 在睡觉，检查品类结构和陈列",
-        }
-    return None
+
+    def check(store: Dict, ctx: Dict) -> Optional[Dict]:
+        active_sku = store.get(active_col, 0)
+        total_sku = store.get(total_col, 0)
+        if total_sku <= 0:
+            return None
+        sell_rate = active_sku / total_sku
+        if sell_rate < min_rate:
+            sleeping = total_sku - active_sku
+            return {
+                "指标": f"动销率 {sell_rate:.0%}",
+                "详情": f"{sleeping} 个 SKU 无销售（共 {total_sku} 个）",
+                "建议": f"⚠️ {sleeping} 个 SKU 在睡觉，检查品类结构和陈列",
+            }
+        return None
+    return check
 
 
 # ============================================================
 # 审计引擎
 # ============================================================
 
-def run_audit(stores: List[Dict], context: Optional[Dict] = None, config: Optional[Dict] = None) -> Dict:
+_BY_SCORE = itemgetter("评分")
+
+
+def run_audit(stores: Iterable[Dict], context: Optional[Dict] = None, config: Optional[Dict] = None) -> Dict:
     """对所有门店运行审计规则，返回异常报告
     
     Args:
-        stores: 门店数据列表
+        stores: 门店数据（列表或生成器均可，只遍历一次）
         context: 额外上下文（如 daily_avg_sold）
         config: 审计配置（从 load_config 加载，None 则用默认）
     """
     ctx = context or {}
     cfg = config or load_config()
     rules_cfg = cfg.get("rules", {})
-    fm = cfg.get("field_mapping", _builtin_defaults()["field_mapping"])
-    scoring = cfg.get("scoring", {"critical_penalty": 25, "warning_penalty": 10, "info_penalty": 3})
+    fm = _compile_field_mapping(cfg.get("field_mapping", DEFAULT_FIELD_MAPPING))
+    scoring = cfg.get("scoring", DEFAULT_SCORING)
 
     report = {
         "audit_time": datetime.now().isoformat(),
         "industry": cfg.get("industry", "未知"),
-        "total_stores": len(stores),
+        "total_stores": 0,  # 遍历完再回填，stores 可以是生成器
         "summary": {"critical": 0, "warning": 0, "info": 0, "healthy": 0},
         "alerts": [],
+        "alerts_by_level": {"critical": [], "warning": [], "info": []},  # 与 alerts 共享同一批告警对象
         "store_scores": [],
     }
 
+    # 规则配置与门店无关：启用状态、阈值和列名（冻结进检查闭包）、告警字段、扣分只解析一次，逐店只跑检查函数
+    summary = report["summary"]
+    by_level = report["alerts_by_level"]
+    rules = []
+    for rule_key, rule_cfg in rules_cfg.items():
+        if rule_key not in RULE_CHECKERS or not rule_cfg.get("enabled", True):
+            continue
+        level = rule_cfg.get("level", "warning")
+        if isinstance(level, str):
+            level = sys.intern(level)  # summary/by_level 逐告警按级别累加
+        summary.setdefault(level, 0)  # 自定义级别也预先登记，循环里直接累加
+        # 告警里与门店无关的字段做成原型，逐条告警 copy 后只填门店名再并入检查结果（键顺序不变）
+        prototype = {
+            "门店": None,
+            "异常类型": rule_cfg.get("name", rule_key),
+            "级别": level,
+            "描述": rule_cfg.get("description", ""),
+        }
+        rules.append((
+            _bind_rule(RULE_CHECKERS[rule_key], rule_cfg.get("thresholds", {}), fm),
+            prototype,
+            level,
+            scoring.get(f"{level}_penalty", 10),
+            by_level.setdefault(level, []),
+        ))
+    rules = tuple(rules)
+    alerts = report["alerts"]
+    store_scores = report["store_scores"]
+    name_col = fm["store_name"]
+
     for store in stores:
-        store_name = _field(store, fm, "store_name", store.get("name", "未知"))
-        store_alerts = []
-
-        for rule_key, rule_cfg in rules_cfg.items():
-            if not rule_cfg.get("enabled", True):
-                continue
-            checker = RULE_CHECKERS.get(rule_key)
-            if not checker:
-                continue
-            thresholds = rule_cfg.get("thresholds", {})
-            result = checker(store, ctx, thresholds, fm)
+        store_name = store[name_col] if name_col in store else store.get("name", "未知")
+        score = 100  # 门店健康评分（100分制），告警与扣分同一遍累计
+        alert_count = 0
+
+        for check, prototype, level, penalty, bucket in rules:
+            result = check(store, ctx)
             if result:
-                alert = {
-                    "门店": store_name,
-                    "异常类型": rule_cfg.get("name", rule_key),
-                    "级别": rule_cfg.get("level", "warning"),
-                    "描述": rule_cfg.get("description", ""),
-                    **result,
-                }
-                store_alerts.append(alert)
-                level = rule_cfg.get("level", "warning")
-                report["summary"][level] = report["summary"].get(level, 0) + 1
-
-        if store_alerts:
-            report["alerts"].extend(store_alerts)
-        else:
-            report["summary"]["healthy"] += 1
-
-        # 门店健康评分（100分制）
-        score = 100
-        for a in store_alerts:
-            level = a["级别"]
-            score -= scoring.get(f"{level}_penalty", 10)
-        report["store_scores"].append({
+                alert = prototype.copy()
+                alert["门店"] = store_name
+                alert.update(result)
+                alerts.append(alert)
+                bucket.append(alert)
+                summary[level] += 1
+                score -= penalty
+                alert_count += 1
+
+        if not alert_count:
+            summary["healthy"] += 1
+        store_scores.append({
             "门店": store_name,
-            "评分": max(0, score),
-            "异常数": len(store_alerts),
+            "评分": score if score > 0 else 0,
+            "异常数": alert_count,
         })
 
-    # 按评分排序
-    report["store_scores"].sort(key=lambda x: x["评分"])
+    report["total_stores"] = len(report["store_scores"])
+
+    # 按评分排序；list.sort 稳定，同分门店保持数据源顺序
+    report["store_scores"].sort(key=_BY_SCORE)
 
     return report
 
@@ -270,70 +413,119 @@ def run_audit(stores: List[Dict], context: Optional[Dict] = None, config: Option
 # 报告生成（Markdown → 飞书文档）
 # ============================================================
 
-def generate_report_markdown(audit_result: Dict) -> str:
-    """从审计结果生成 Markdown 报告"""
+def report_date(audit_result: Dict) -> str:
+    """报告日期（YYYY-MM-DD）：直接取审计结果里 ISO 格式 audit_time 的日期部分，不再读时钟"""
+    audit_time = audit_result.get("audit_time")
+    return audit_time[:10] if audit_time else datetime.now().strftime("%Y-%m-%d")
+
+
+def generate_report_markdown(audit_result: Dict, date_str: Optional[str] = None) -> str:
+    """从审计结果生成 Markdown 报告；date_str 缺省取 report_date(audit_result)"""
+    buf = io.StringIO()
+    w = buf.write
+    for kind, text in _report_lines(audit_result, date_str):
+        w(_MD_PREFIX[kind])
+        w(text)
+        w("\n")
+    return buf.getvalue()
+
+
+def iter_report_blocks(audit_result: Dict, date_str: Optional[str] = None) -> Iterator[Dict]:
+    """从审计结果直接产出飞书 block，与 _markdown_to_blocks(generate_report_markdown(...)) 一致，
+    省去拼接整篇 Markdown 再逐行解析"""
+    for kind, text in _report_lines(audit_result, date_str):
+        if kind != "blank":
+            yield _REPORT_BLOCK[kind](text)
+
+
+# 报告行类型 → Markdown 行首标记 / 飞书 block
+_MD_PREFIX = {"h1": "# ", "h2": "## ", "h3": "### ", "bullet": "- ", "quote": "> ", "row": "", "blank": ""}
+_REPORT_BLOCK = {
+    "h1": lambda text: _heading_block(1, text),
+    "h2": lambda text: _heading_block(2, text),
+    "h3": lambda text: _heading_block(3, text),
+    "bullet": lambda text: _bullet_block(text),
+    "quote": lambda text: _text_block(text),
+    "row": lambda text: _text_block(text),
+}
+
+
+def _report_lines(audit_result: Dict, date_str: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """报告结构的唯一来源：逐行产出 (行类型, 正文)，Markdown 和飞书 block 都由它渲染"""
     s = audit_result["summary"]
-    lines = []
 
-    date_str = datetime.now().strftime("%Y-%m-%d")
+    date_str = date_str or report_date(audit_result)
     industry = audit_result.get("industry", "")
-    lines.append(f"# 门店运营诊断报告 {date_str}")
+    yield "h1", f"门店运营诊断报告 {date_str}"
     if industry:
-        lines.append(f"> 行业配置：{industry}")
-    lines.append("")
+        yield "quote", f"行业配置：{industry}"
+    yield "blank", ""
 
     # 总览
-    lines.append("## 📊 总览")
-    lines.append("")
     total = audit_result["total_stores"]
-    lines.append(f"- 门店总数：{total}")
     healthy_pct = f" ({s['healthy']/total:.0%})" if total > 0 else ""
-    lines.append(f"- 🟢 健康门店：{s['healthy']}{healthy_pct}")
-    lines.append(f"- 🔴 严重异常：{s['critical']} 条")
-    lines.append(f"- 🟡 警告：{s['warning']} 条")
-    lines.append("")
-
-    critical_alerts = [a for a in audit_result["alerts"] if a["级别"] == "critical"]
-    if critical_alerts:
-        lines.append("## 🔴 严重异常（需立即处理）")
-        lines.append("")
-        for a in critical_alerts:
-            lines.append(f"### {a['门店']} — {a['异常类型']}")
-            lines.append(f"- **指标**：{a['指标']}")
-            lines.append(f"- **详情**：{a['详情']}")
-            lines.append(f"- **建议**：{a['建议']}")
-            lines.append("")
-
-    warning_alerts = [a for a in audit_result["alerts"] if a["级别"] == "warning"]
-    if warning_alerts:
-        lines.append("## 🟡 警告（需关注）")
-        lines.append("")
-        for a in warning_alerts:
-            lines.append(f"### {a['门店']} — {a['异常类型']}")
-            lines.append(f"- **指标**：{a['指标']}")
-            lines.append(f"- **详情**：{a['详情']}")
-            lines.append(f"- **建议**：{a['建议']}")
-            lines.append("")
-
-    lines.append("## 📋 门店健康排名")
-    lines.append("")
-    lines.append("| 排名 | 门店 | 健康评分 | 异常数 |")
-    lines.append("|------|------|---------|--------|")
+    yield "h2", "📊 总览"
+    yield "blank", ""
+    yield "bullet", f"门店总数：{total}"
+    yield "bullet", f"🟢 健康门店：{s['healthy']}{healthy_pct}"
+    yield "bullet", f"🔴 严重异常：{s['critical']} 条"
+    yield "bullet", f"🟡 警告：{s['warning']} 条"
+    yield "blank", ""
+
+    by_level = _alerts_by_level(audit_result)
+    for level, title in _ALERT_SECTIONS:
+        level_alerts = by_level.get(level)
+        if not level_alerts:
+            continue
+        yield "h2", title
+        yield "blank", ""
+        for a in level_alerts:
+            yield "h3", f"{a['门店']} — {a['异常类型']}"
+            yield "bullet", f"**指标**：{a['指标']}"
+            yield "bullet", f"**详情**：{a['详情']}"
+            yield "bullet", f"**建议**：{a['建议']}"
+            yield "blank", ""
+
+    yield "h2", "📋 门店健康排名"
+    yield "blank", ""
+    yield "row", "| 排名 | 门店 | 健康评分 | 异常数 |"
+    yield "row", "|------|------|---------|--------|"
     for i, ss in enumerate(audit_result["store_scores"], 1):
         score = ss["评分"]
-        emoji = "🔴" if score < 50 else "🟡" if score < 75 else "🟢"
-        lines.append(f"| {i} | {ss['门店']} | {emoji} {score} | {ss['异常数']} |")
-    lines.append("")
+        yield "row", f"| {i} | {ss['门店']} | {_score_emoji(score)} {score} | {ss['异常数']} |"
+
 
-    return "\n".join(lines)
+_ALERT_SECTIONS = (("critical", "🔴 严重异常（需立即处理）"), ("warning", "🟡 警告（需关注）"))
 
 
-def publish_report_to_feishu(markdown: str, doc_token: Optional[str] = None, folder_token: Optional[str] = None) -> str:
-    """将报告发布到飞书文档，分批写入避免 API 限制"""
-    import time as _time
+def _alerts_by_level(audit_result: Dict) -> Dict[str, List[Dict]]:
+    """run_audit 已按级别分好组；旧格式结果（只有 alerts）在这里一次遍历补分组"""
+    by_level = audit_result.get("alerts_by_level")
+    if by_level is None:
+        by_level = {}
+        for a in audit_result["alerts"]:
+            by_level.setdefault(a["级别"], []).append(a)
+    return by_level
 
+
+def _score_emoji(score: int) -> str:
+    return "🔴" if score < 50 else "🟡" if score < 75 else "🟢"
+
+
+def publish_report_to_feishu(
+    markdown: Optional[str] = None,
+    doc_token: Optional[str] = None,
+    folder_token: Optional[str] = None,
+    blocks: Optional[Iterable[Dict]] = None,
+    date_str: Optional[str] = None,
+) -> str:
+    """将报告发布到飞书文档，分批写入避免 API 限制
+
+    已有审计结果时传 blocks=iter_report_blocks(result)，不必先生成 Markdown 再解析；
+    date_str 传 report_date(result)，新建文档标题与报告正文同一日期
+    """
     if not doc_token:
-        date_str = datetime.now().strftime("%Y-%m-%d")
+        date_str = date_str or datetime.now().strftime("%Y-%m-%d")
         title = f"门店运营诊断报告 {date_str}"
         result = api.docx_create_document(title, folder_token)
         doc_token = result.get("document", {}).get("document_id", "")
@@ -341,94 +533,104 @@ def publish_report_to_feishu(markdown: str, doc_token: Optional[str] = None, fol
     if not doc_token:
         raise Exception("无法创建文档")
 
-    blocks = _markdown_to_blocks(markdown)
-
-    batch_size = 5
-    for i in range(0, len(blocks), batch_size):
-        chunk = blocks[i : i + batch_size]
-        try:
-            api._post(f"/docx/v1/documents/{doc_token}/blocks/{doc_token}/children", {
-                "children": chunk,
-            })
-        except Exception as e:
-            for block in chunk:
-                try:
-                    api._post(f"/docx/v1/documents/{doc_token}/blocks/{doc_token}/children", {
-                        "children": [block],
-                    })
-                except Exception:
-                    pass
-        if i + batch_size < len(blocks):
-            _time.sleep(0.3)
+    blocks = _markdown_to_blocks(markdown) if blocks is None else list(blocks)
+    api.docx_append_blocks(doc_token, blocks, skip_failed=True)
 
     return doc_token
 
 
+# 行首标记 → 生成 block；表格行整行作为文本，其余去掉标记后的正文
+_MD_LINE_RE = re.compile(r"(#{1,3} |\| |- |> )?(.*)", re.S)
+_MD_HANDLERS = {
+    "# ": lambda body, line: _heading_block(1, body),
+    "## ": lambda body, line: _heading_block(2, body),
+    "### ": lambda body, line: _heading_block(3, body),
+    "| ": lambda body, line: _text_block(line),
+    "- ": lambda body, line: _bullet_block(body),
+    "> ": lambda body, line: _text_block(body),
+}
+
+
 def _markdown_to_blocks(md: str) -> List[Dict]:
     """简易 Markdown → 飞书 Block 转换"""
     blocks = []
-    for line in md.split("\n"):
-        if not line.strip():
-            continue
-        if line.startswith("# "):
-            blocks.append(_heading_block(1, line[2:]))
-        elif line.startswith("## "):
-            blocks.append(_heading_block(2, line[3:]))
-        elif line.startswith("### "):
-            blocks.append(_heading_block(3, line[4:]))
-        elif line.startswith("| "):
-            blocks.append(_text_block(line))
-        elif line.startswith("- "):
-            blocks.append(_bullet_block(line[2:]))
-        elif line.startswith("> "):
-            blocks.append(_text_block(line[2:]))
-        else:
-            blocks.append(_text_block(line))
+    match = _MD_LINE_RE.match
+    get_handler = _MD_HANDLERS.get
+    for line in filter(str.strip, md.split("\n")):  # 空行只用于 Markdown 排版，block 里直接丢掉
+        m = match(line)
+        handler = get_handler(m.group(1))
+        blocks.append(handler(m.group(2), line) if handler else _text_block(line))
     return blocks
 
 
+# 标题级别 → (block_type, 内容键)
+_HEADING_KINDS = {level: (level + 2, f"heading{level}") for level in (1, 2, 3)}
+
+
 def _heading_block(level: int, text: str) -> Dict:
-    block_type = level + 2
-    key = f"heading{level}"
-    return {
-        "block_type": block_type,
-        key: {"elements": [_text_element(text)]},
-    }
+    block_type, key = _HEADING_KINDS[level]
+    return {"block_type": block_type, key: {"elements": [{"text_run": {"content": text}}]}}
 
 
 def _text_block(text: str) -> Dict:
-    return {
-        "block_type": 2,
-        "text": {"elements": _parse_inline(text)},
-    }
+    return {"block_type": 2, "text": {"elements": _parse_inline(text)}}
 
 
 def _bullet_block(text: str) -> Dict:
-    return {
-        "block_type": 12,
-        "bullet": {"elements": _parse_inline(text)},
-    }
+    return {"block_type": 12, "bullet": {"elements": _parse_inline(text)}}
 
 
 def _parse_inline(text: str) -> List[Dict]:
     """解析加粗等内联格式"""
-    elements = []
-    parts = text.split("**")
-    for i, part in enumerate(parts):
-        if not part:
-            continue
-        if i % 2 == 1:
-            elements.append(_text_element(part, bold=True))
-        else:
-            elements.append(_text_element(part))
-    return elements if elements else [_text_element(text)]
+    if "**" not in text:  # 大多数行没有内联格式
+        return [{"text_run": {"content": text}}]
+    elements = [_text_element(part, bold=i % 2 == 1) for i, part in enumerate(text.split("**")) if part]
+    return elements or [{"text_run": {"content": text}}]
 
 
 def _text_element(text: str, bold: bool = False) -> Dict:
-    el = {"text_run": {"content": text}}
+    # 一次写出完整字面量，不先建再改
     if bold:
-        el["text_run"]["text_element_style"] = {"bold": True}
-    return el
+        return {"text_run": {"content": text, "text_element_style": {"bold": True}}}
+    return {"text_run": {"content": text}}
+
+
+# ============================================================
+# 结构化输出（CSV，供下游分析）
+# ============================================================
+
+ALERT_CSV_COLUMNS = ("门店", "异常类型", "级别", "描述", "指标", "详情", "建议")
+SCORE_CSV_COLUMNS = ("排名", "门店", "评分", "异常数")
+
+
+def write_audit_csv(audit_result: Dict, out_dir: str) -> Dict[str, str]:
+    """告警明细、门店评分各写一份 CSV，DuckDB / Polars / Excel 可直接读取，不必再解析 Markdown 表格
+
+    Returns:
+        {"alerts": 告警 CSV 路径, "store_scores": 评分 CSV 路径}
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {
+        "alerts": os.path.join(out_dir, "alerts.csv"),
+        "store_scores": os.path.join(out_dir, "store_scores.csv"),
+    }
+
+    alerts = audit_result["alerts"]
+    # 自定义规则可能返回额外字段，接在固定列之后
+    columns = list(dict.fromkeys(itertools.chain(ALERT_CSV_COLUMNS, *alerts)))
+    with open(paths["alerts"], "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(alerts)
+
+    with open(paths["store_scores"], "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(SCORE_CSV_COLUMNS)
+        writer.writerows(
+            (i, ss["门店"], ss["评分"], ss["异常数"]) for i, ss in enumerate(audit_result["store_scores"], 1)
+        )
+
+    return paths
 
 
 # ============================================================
@@ -436,9 +638,13 @@ def _text_element(text: str, bold: bool = False) -> Dict:
 # ============================================================
 
 def generate_demo_data(num_stores: int = 50) -> List[Dict]:
-    """生成模拟的50家门店数据"""
+    """生成模拟的50家门店数据（固定种子，结果可复现）"""
     import random
-    random.seed(42)
+    # 独立的随机数生成器：不重置调用方的全局 random 状态；方法预先绑定，循环内少一次属性查找。
+    # randint(a, b) 即 randrange(a, b + 1)，uniform(a, b) 即 a + (b - a) * random()，
+    # 直接展开省掉一层 Python 调用，随机序列与数据不变
+    rng = random.Random(42)
+    randrange, rand = rng.randrange, rng.random
 
     regions = ["华东", "华南", "华北", "西南", "华中"]
     cities = {
@@ -455,38 +661,38 @@ def generate_demo_data(num_stores: int = 50) -> List[Dict]:
         city = cities[region][i // 10 % 5]
         store_name = f"{city}{i+1:02d}店"
 
-        target = random.randint(8000, 50000)
+        target = randrange(8000, 50001)
         if i < 5:
-            actual = int(target * random.uniform(0.25, 0.55))
+            actual = int(target * (0.25 + (0.55 - 0.25) * rand()))
         elif i < 10:
-            actual = int(target * random.uniform(0.90, 1.20))
+            actual = int(target * (0.90 + (1.20 - 0.90) * rand()))
         elif i < 13:
             actual = 0
         elif i < 16:
-            actual = int(target * random.uniform(0.60, 0.90))
+            actual = int(target * (0.60 + (0.90 - 0.60) * rand()))
         else:
-            actual = int(target * random.uniform(0.65, 1.15))
+            actual = int(target * (0.65 + (1.15 - 0.65) * rand()))
 
-        initial_stock = random.randint(200, 800)
+        initial_stock = randrange(200, 801)
         if i < 10 and i >= 5:
-            sold = int(initial_stock * random.uniform(0.88, 0.97))
+            sold = int(initial_stock * (0.88 + (0.97 - 0.88) * rand()))
         elif i >= 16 and i < 25:
-            sold = int(initial_stock * random.uniform(0.05, 0.18))
+            sold = int(initial_stock * (0.05 + (0.18 - 0.05) * rand()))
         else:
-            sold = int(initial_stock * random.uniform(0.30, 0.75))
+            sold = int(initial_stock * (0.30 + (0.75 - 0.30) * rand()))
 
         current_stock = initial_stock - sold
         if 13 <= i < 16:
-            current_stock = random.randint(-50, -5)
+            current_stock = randrange(-50, -4)
 
-        total_sku = random.randint(80, 200)
+        total_sku = randrange(80, 201)
         if i >= 30 and i < 35:
-            active_sku = int(total_sku * random.uniform(0.30, 0.55))
+            active_sku = int(total_sku * (0.30 + (0.55 - 0.30) * rand()))
         else:
-            active_sku = int(total_sku * random.uniform(0.62, 0.92))
+            active_sku = int(total_sku * (0.62 + (0.92 - 0.62) * rand()))
 
         daily_avg_sold = max(1, sold // 7)
-        avg_inventory_value = current_stock * random.randint(80, 300)
+        avg_inventory_value = current_stock * randrange(80, 301)
         daily_cogs = max(1, actual * 0.6 / 7)
 
         stores.append({
@@ -498,7 +704,7 @@ def generate_demo_data(num_stores: int = 50) -> List[Dict]:
             "期初库存": initial_stock,
             "销售数量": sold,
             "当前库存": current_stock,
-            "上架天数": random.randint(7, 30),
+            "上架天数": randrange(7, 31),
             "总SKU数": total_sku,
             "有销SKU数": active_sku,
             "平均库存金额": avg_inventory_value,
@@ -524,6 +730,7 @@ def main():
     p_demo.add_argument("--publish", action="store_true", help="发布到飞书文档")
     p_demo.add_argument("--folder", help="飞书文件夹 token")
     p_demo.add_argument("--output", help="输出 Markdown 文件路径")
+    p_demo.add_argument("--csv-dir", help="另存告警明细/门店评分 CSV 的目录")
 
     # audit
     p_audit = sub.add_parser("audit", help="从 bitable 读取数据并审计")
@@ -534,6 +741,7 @@ def main():
     p_audit.add_argument("--config", help="审计规则配置文件路径 (YAML)")
     p_audit.add_argument("--publish", action="store_true", help="发布到飞书文档")
     p_audit.add_argument("--folder", help="飞书文件夹 token")
+    p_audit.add_argument("--csv-dir", help="另存告警明细/门店评分 CSV 的目录")
 
     # list-configs
     p_list = sub.add_parser("list-configs", help="列出可用的配置文件")
@@ -571,7 +779,8 @@ def main():
         print(f"  🟡 警告: {result['summary']['warning']} 条")
         print(f"  🟢 健康门店: {result['summary']['healthy']} 家")
 
-        md = generate_report_markdown(result)
+        date_str = report_date(result)
+        md = generate_report_markdown(result, date_str)
 
         if args.output:
             os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
@@ -579,9 +788,15 @@ def main():
                 f.write(md)
             print(f"\n报告已保存: {args.output}")
 
+        if args.csv_dir:
+            paths = write_audit_csv(result, args.csv_dir)
+            print(f"CSV 已保存: {paths['alerts']}, {paths['store_scores']}")
+
         if args.publish:
             print("\n发布到飞书...", flush=True)
-            doc_id = publish_report_to_feishu(md, folder_token=args.folder)
+            doc_id = publish_report_to_feishu(
+                blocks=iter_report_blocks(result, date_str), folder_token=args.folder, date_str=date_str
+            )
             print(f"飞书文档已创建: https://my.feishu.cn/docx/{doc_id}")
         elif not args.output:
             print("\n" + md)
@@ -589,27 +804,35 @@ def main():
     elif args.command == "audit":
         print(f"配置: {cfg.get('industry', '默认')}", flush=True)
         print("从 bitable 读取数据...", flush=True)
-        records = api.bitable_list_all_records(args.app, args.sales_table)
-        stores = [r.get("fields", {}) for r in records]
-
+        stores = None
         if args.target_table:
             import bitable_engine as engine
-            joined = engine.cross_table_join(
+            joined = engine.iter_cross_table_join(
                 args.app, args.sales_table, args.target_table, "门店名称"
             )
-            if joined:
-                stores = joined
+            # 只探一行判断 JOIN 是否为空，其余结果边产出边审计，不物化整张连接表
+            first = next(joined, None)
+            if first is not None:
+                stores = itertools.chain((first,), joined)
+        if stores is None:
+            # 边分页读取边审计，不持有整表记录
+            stores = (r.get("fields", {}) for r in api.bitable_iter_all_records_prefetch(args.app, args.sales_table))
 
-        print(f"读取到 {len(stores)} 家门店数据", flush=True)
         result = run_audit(stores, config=cfg)
+        print(f"读取到 {result['total_stores']} 家门店数据", flush=True)
 
-        md = generate_report_markdown(result)
+        if args.csv_dir:
+            paths = write_audit_csv(result, args.csv_dir)
+            print(f"CSV 已保存: {paths['alerts']}, {paths['store_scores']}", flush=True)
 
         if args.publish:
-            doc_id = publish_report_to_feishu(md, folder_token=args.folder)
+            date_str = report_date(result)
+            doc_id = publish_report_to_feishu(
+                blocks=iter_report_blocks(result, date_str), folder_token=args.folder, date_str=date_str
+            )
             print(f"飞书文档已创建: https://my.feishu.cn/docx/{doc_id}")
         else:
-            print(md)
+            print(generate_report_markdown(result))
 
 
 if __name__ == "__main__":
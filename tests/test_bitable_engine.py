@@ -7,6 +7,8 @@ import os
 import sys
 import tempfile
 import unittest
+from decimal import Decimal
+from unittest import mock
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
 import bitable_engine as be
@@ -42,6 +44,20 @@ class TestLoadRecordsFromCSV(unittest.TestCase):
         self.assertEqual(records[0]["name"], "hello world")
         os.unlink(path)
 
+    def test_numeric_detection(self):
+        path = self._write_csv([{"a": "-12", "b": "0.5", "c": "1.2.3", "d": "12abc", "e": ""}], ["a", "b", "c", "d", "e"])
+        record = be.load_records_from_file(path)[0]
+        self.assertEqual(record, {"a": -12, "b": 0.5, "c": "1.2.3", "d": "12abc", "e": ""})
+        os.unlink(path)
+
+    def test_exponent_and_underscore_numbers(self):
+        # 与 int()/float() 的语法一致：没有 "." 的指数写法按 int 转不了，保留原样
+        row = {"a": "1.5e3", "b": "1_000", "c": "1e3", "d": "a_b", "e": "1.5E-1"}
+        path = self._write_csv([row], list(row))
+        record = be.load_records_from_file(path)[0]
+        self.assertEqual(record, {"a": 1500.0, "b": 1000, "c": "1e3", "d": "a_b", "e": 0.15})
+        os.unlink(path)
+
     def test_empty_csv(self):
         path = self._write_csv([], ["a", "b"])
         records = be.load_records_from_file(path)
@@ -143,5 +159,142 @@ class TestBatchUpdateDryRun(unittest.TestCase):
         self.assertEqual(result["updated"], 0)
 
 
+class TestBatchChunking(unittest.TestCase):
+    """分片并发提交（mock 掉 API 调用）"""
+
+    def test_chunks_all_submitted(self):
+        calls = []
+        with mock.patch.object(be.api, "bitable_batch_create_records", side_effect=lambda a, t, c: calls.append(len(c))):
+            result = be.batch_create("app", "table", [{"i": i} for i in range(1201)])
+        self.assertEqual(result["created"], 1201)
+        self.assertEqual(sorted(calls), [201, 500, 500])
+        self.assertEqual(result["errors"], [])
+
+    def test_failed_chunk_reported(self):
+        def fake(app, table, chunk):
+            if chunk[0]["i"] == 500:
+                raise Exception("boom")
+        with mock.patch.object(be.api, "bitable_batch_create_records", side_effect=fake):
+            result = be.batch_create("app", "table", [{"i": i} for i in range(1000)])
+        self.assertEqual(result["created"], 500)
+        self.assertEqual(result["errors"][0]["offset"], 500)
+
+
+class TestCrossTableJoin(unittest.TestCase):
+    LEFT = [
+        {"fields": {"门店": "A", "销售额": 100}},
+        {"fields": {"门店": "B", "销售额": 200}},
+        {"fields": {"门店": "C", "销售额": 300}},
+    ]
+    RIGHT = [
+        {"fields": {"门店": "A", "目标": 150}},
+        {"fields": {"门店": "A", "目标": 160}},
+        {"fields": {"门店": "B", "目标": 250, "销售额": 999}},
+    ]
+
+    def _join(self, select=None):
+        tables = {"left": self.LEFT, "right": self.RIGHT}
+        with mock.patch.object(be.api, "bitable_iter_all_records", side_effect=lambda app, t, *a, **kw: iter(tables[t])):
+            return be.cross_table_join("app", "left", "right", "门店", select)
+
+    def test_inner_join_with_duplicates(self):
+        rows = self._join()
+        self.assertEqual([r["目标"] for r in rows], [150, 160, 250])
+        self.assertEqual(rows[0]["销售额"], 100)
+
+    def test_right_side_wins_on_conflict(self):
+        rows = self._join()
+        self.assertEqual(rows[2]["销售额"], 999)
+
+    def test_select_fields(self):
+        rows = self._join(["门店", "目标", "不存在"])
+        self.assertEqual(rows[0], {"门店": "A", "目标": 150})
+
+    def test_non_text_join_key(self):
+        self.LEFT = [{"fields": {"门店": {"value": 1}, "销售额": 100}}]
+        self.RIGHT = [{"fields": {"门店": {"value": 1}, "目标": 150}}]
+        self.assertEqual(self._join(), [{"门店": {"value": 1}, "销售额": 100, "目标": 150}])
+
+
+class TestSnapshot(unittest.TestCase):
+    FIELDS = [{"field_name": "名称", "type": 1}]
+    RECORDS = [{"record_id": "r1", "fields": {"名称": "甲"}}, {"record_id": "r2", "fields": {}}]
+
+    def _snapshot_path(self, **kw):
+        out = tempfile.mkdtemp()
+        with mock.patch.object(be.api, "bitable_list_fields", return_value=self.FIELDS), \
+             mock.patch.object(be.api, "bitable_list_all_records", return_value=self.RECORDS):
+            return be.snapshot("app", "tbl", out, **kw)
+
+    def _snapshot(self, **kw):
+        with open(self._snapshot_path(fmt="json", **kw), encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_ndjson_is_default(self):
+        path = self._snapshot_path()
+        self.assertTrue(path.endswith(".ndjson"))
+        with open(path, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[0]["record_count"], 2)
+        self.assertEqual(lines[1:], [{"record_id": "r1", "fields": {"名称": "甲"}}, {"record_id": "r2", "fields": {}}])
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self._snapshot_path(fmt="xml")
+
+    def test_pretty_rejected_for_ndjson(self):
+        with self.assertRaises(ValueError):
+            self._snapshot_path(pretty=True)
+
+    def test_json_uses_same_encoder_as_ndjson(self):
+        self.RECORDS = [{"record_id": "r1", "fields": {"金额": Decimal("1.50")}}]  # 标准库 json 直接编码会失败
+        for pretty in (False, True):
+            self.assertEqual(self._snapshot(pretty=pretty)["records"][0]["fields"], {"金额": "1.50"})
+
+    def test_compact_snapshot_roundtrip(self):
+        data = self._snapshot()
+        self.assertEqual(data["record_count"], 2)
+        self.assertEqual(data["records"][0], {"record_id": "r1", "fields": {"名称": "甲"}})
+
+    def test_pretty_snapshot_same_content(self):
+        compact, pretty = self._snapshot(), self._snapshot(pretty=True)
+        compact.pop("snapshot_time"), pretty.pop("snapshot_time")
+        self.assertEqual(compact, pretty)
+
+
+class TestStats(unittest.TestCase):
+    FIELDS = [
+        {"field_name": "名称", "type": 1},
+        {"field_name": "金额", "type": 2},
+        {"field_name": "状态", "type": 3},
+        {"field_name": "标签", "type": 4},
+    ]
+    RECORDS = [
+        {"fields": {"名称": "a", "金额": 10, "状态": "完成", "标签": ["x", "y"]}},
+        {"fields": {"名称": "b", "金额": 30.5, "状态": "完成", "标签": ["x"]}},
+        {"fields": {"名称": "", "状态": "进行中", "标签": []}},
+    ]
+
+    def _stats(self):
+        with mock.patch.object(be.api, "bitable_list_fields", return_value=self.FIELDS), \
+             mock.patch.object(be.api, "bitable_list_all_records_cached", return_value=self.RECORDS):
+            return {f["name"]: f for f in be.stats("app", "tbl")["fields"]}
+
+    def test_fill_rate(self):
+        result = self._stats()
+        self.assertEqual(result["名称"]["fill_rate"], "2/3")
+        self.assertEqual(result["标签"]["fill_rate"], "2/3")
+
+    def test_number_field(self):
+        amount = self._stats()["金额"]
+        self.assertEqual((amount["min"], amount["max"], amount["sum"]), (10, 30.5, 40.5))
+        self.assertEqual(amount["avg"], 20.25)
+
+    def test_select_distribution(self):
+        result = self._stats()
+        self.assertEqual(result["状态"]["distribution"], {"完成": 2, "进行中": 1})
+        self.assertEqual(result["标签"]["distribution"], {"x": 2, "y": 1})
+
+
 if __name__ == "__main__":
     unittest.main()
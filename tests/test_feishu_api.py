@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""test_feishu_api.py — API 封装层单元测试（不发真实请求）"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import feishu_api as api
+
+
+def _token_resp(body):
+    resp = mock.Mock(status_code=200)
+    resp.content = json.dumps(body).encode("utf-8")
+    return resp
+
+
+class TestRunConcurrently(unittest.TestCase):
+    def test_results_in_call_order(self):
+        gate = threading.Barrier(2, timeout=5)
+
+        def slow(x):
+            gate.wait()  # 两个调用必须同时在跑才能通过
+            return x * 2
+
+        self.assertEqual(api.run_concurrently((slow, 1), (slow, 5)), [2, 10])
+
+    def test_single_call_runs_inline(self):
+        self.assertEqual(api.run_concurrently((len, "abc")), [3])
+
+    def test_exception_propagates(self):
+        def boom():
+            raise ValueError("x")
+        with self.assertRaises(ValueError):
+            api.run_concurrently((boom,), (len, "a"))
+
+
+class TestSharedTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "token.json")
+        env = {"FEISHU_APP_ID": "cli_test", "FEISHU_APP_SECRET": "s",
+               "FEISHU_TOKEN_CACHE": "file", "FEISHU_TOKEN_FILE": self.path}
+        patches = [mock.patch.dict(os.environ, env),
+                   mock.patch.object(api, "APP_ID", "cli_test"),
+                   mock.patch.dict(api._token_cache, {"token": None, "expires_at": 0})]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    @unittest.skipIf(api.fcntl is None, "需要 fcntl")
+    def test_token_reused_from_file(self):
+        api._store_shared_token("t-shared", time.time() + 3600)
+        self.assertEqual(oct(os.stat(self.path).st_mode & 0o777), "0o600")
+        with mock.patch.object(api._HTTP, "post", side_effect=AssertionError("不应请求 token")):
+            self.assertEqual(api.get_token(), "t-shared")
+
+    @unittest.skipIf(api.fcntl is None, "需要 fcntl")
+    def test_expired_shared_token_ignored(self):
+        api._store_shared_token("t-old", time.time() + 30)
+        resp = _token_resp({"code": 0, "tenant_access_token": "t-new", "expire": 7200})
+        with mock.patch.object(api._HTTP, "post", return_value=resp):
+            self.assertEqual(api.get_token(), "t-new")
+        self.assertEqual(api._load_shared_token()["token"], "t-new")
+
+    def test_concurrent_callers_refresh_once(self):
+        resp = _token_resp({"code": 0, "tenant_access_token": "t", "expire": 7200})
+
+        def slow_post(*a, **kw):
+            time.sleep(0.05)
+            return resp
+
+        with mock.patch.dict(os.environ, {"FEISHU_TOKEN_CACHE": "off"}), \
+             mock.patch.object(api._HTTP, "post", side_effect=slow_post) as post:
+            threads = [threading.Thread(target=api.get_token) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(post.call_count, 1)
+        remaining = api._token_cache["expires_at"] - time.time()
+        self.assertTrue(7200 - 121 < remaining < 7200 - 29)
+
+    def test_token_near_expiry_is_refreshed(self):
+        api._token_cache.update(token="t-old", expires_at=time.time() + 200)
+        resp = _token_resp({"code": 0, "tenant_access_token": "t-new", "expire": 7200})
+        with mock.patch.dict(os.environ, {"FEISHU_TOKEN_CACHE": "off"}), \
+             mock.patch.object(api._HTTP, "post", return_value=resp):
+            self.assertEqual(api.get_token(), "t-new")
+
+    def test_corrupt_file_is_ignored(self):
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        self.assertIsNone(api._load_shared_token())
+
+
+class TestRequestScope(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        @api.request_scoped
+        def fetch(table, flt=None):
+            self.calls.append(table)
+            time.sleep(0.02)
+            return [table]
+        self.fetch = fetch
+
+    def test_outside_scope_not_cached(self):
+        self.fetch("t")
+        self.fetch("t")
+        self.assertEqual(self.calls, ["t", "t"])
+
+    def test_coalesced_within_scope_only(self):
+        with api.with_request_scope():
+            a = self.fetch("t")
+            self.assertIs(self.fetch("t"), a)
+            self.fetch("t", flt="x")
+        self.fetch("t")
+        self.assertEqual(self.calls, ["t", "t", "t"])
+
+    def test_concurrent_duplicates_share_one_call(self):
+        with api.with_request_scope():
+            results = api.run_concurrently(*[(self.fetch, "t")] * 4)
+        self.assertEqual(self.calls, ["t"])
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_failure_not_cached(self):
+        @api.request_scoped
+        def flaky():
+            self.calls.append(1)
+            if len(self.calls) == 1:
+                raise ValueError("x")
+            return "ok"
+
+        with api.with_request_scope():
+            with self.assertRaises(ValueError):
+                flaky()
+            self.assertEqual(flaky(), "ok")
+
+
+class TestBatchAll(unittest.TestCase):
+    def test_chunks_in_order(self):
+        seen = []
+
+        def fake(app, table, chunk):
+            seen.append(len(chunk))
+            return {"first": chunk[0]}
+
+        with mock.patch.object(api, "bitable_batch_create_records", side_effect=fake):
+            results = api.bitable_batch_create_all("app", "tbl", ({"i": i} for i in range(1100)))
+        self.assertEqual(sorted(seen), [100, 500, 500])
+        self.assertEqual([r["first"]["i"] for r in results], [0, 500, 1000])
+
+    def test_empty(self):
+        self.assertEqual(api.bitable_batch_delete_all("app", "tbl", []), [])
+
+    def test_first_error_raised(self):
+        def fake(app, table, chunk):
+            if chunk[0] >= 500:
+                raise ValueError(chunk[0])
+            return {}
+
+        with mock.patch.object(api, "bitable_batch_delete_records", side_effect=fake):
+            with self.assertRaises(ValueError) as cm:
+                api.bitable_batch_delete_all("app", "tbl", list(range(1600)))
+        self.assertEqual(cm.exception.args[0], 500)
+
+    def test_run_batches_reports_each_chunk(self):
+        def fake(app, table, chunk):
+            if chunk[0] == 500:
+                raise ValueError("boom")
+            return len(chunk)
+
+        outcomes = api.run_batches(fake, "app", "tbl", range(1200))
+        self.assertEqual([(o, len(c), r) for o, c, r, _ in outcomes], [(0, 500, 500), (500, 500, None), (1000, 200, 200)])
+        self.assertEqual([str(e) if e else None for *_, e in outcomes], [None, "boom", None])
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        for fn in (api.bitable_list_fields, api.bitable_list_tables):
+            fn.cache.clear()
+            self.addCleanup(fn.cache.clear)
+
+    def test_fields_cached_and_invalidated(self):
+        with mock.patch.object(api, "_get", return_value={"items": [{"field_name": "a"}]}) as get:
+            api.bitable_list_fields("app", "t1")
+            api.bitable_list_fields("app", "t1")
+            api.bitable_list_fields("app", "t2")
+            self.assertEqual(get.call_count, 2)
+
+            api.bitable_invalidate_cache("app", "t1")
+            api.bitable_list_fields("app", "t1")
+            api.bitable_list_fields("app", "t2")
+            self.assertEqual(get.call_count, 3)
+
+    def test_expired_entry_refetched(self):
+        @api.ttl_cache(0)
+        def f(x):
+            calls.append(x)
+            return x
+
+        calls = []
+        f(1)
+        f(1)
+        self.assertEqual(calls, [1, 1])
+
+    def test_invalidate_whole_app(self):
+        with mock.patch.object(api, "_get", return_value={"items": []}) as get:
+            api.bitable_list_tables("app")
+            api.bitable_list_fields("app", "t1")
+            api.bitable_list_fields("other", "t1")
+            api.bitable_invalidate_cache("app")
+            api.bitable_list_tables("app")
+            api.bitable_list_fields("app", "t1")
+            api.bitable_list_fields("other", "t1")
+            self.assertEqual(get.call_count, 5)
+
+
+class TestCachedRecords(unittest.TestCase):
+    def setUp(self):
+        api._records_cache.clear()
+        self.addCleanup(api._records_cache.clear)
+
+    def test_reused_within_minute_and_replaced_after(self):
+        rows = [{"record_id": "r1", "fields": {"标签": ["a"]}}]
+        with mock.patch.object(api, "bitable_iter_all_records", side_effect=lambda *a: iter(rows)) as fetch, \
+             mock.patch.object(api.time, "time", return_value=60 * 100):
+            first = api.bitable_list_all_records_cached("app", "t")
+            first[0]["fields"]["标签"].append("改过")  # 调用方修改不影响缓存
+            self.assertEqual(api.bitable_list_all_records_cached("app", "t"), rows)
+            api.time.time.return_value = 60 * 101
+            api.bitable_list_all_records_cached("app", "t")
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(list(api._records_cache), [("app", "t", None)])
+        self.assertEqual(api._records_cache[("app", "t", None)][0], 101)
+
+    def test_copies_within_request_scope(self):
+        rows = [{"record_id": "r1", "fields": {"标签": ["a"]}}]
+        with mock.patch.object(api, "bitable_iter_all_records", side_effect=lambda *a: iter(rows)) as fetch, \
+             api.with_request_scope():
+            first = api.bitable_list_all_records_cached("app", "t")
+            first[0]["fields"]["标签"].append("改过")
+            self.assertEqual(api.bitable_list_all_records_cached("app", "t"), rows)
+        self.assertEqual(fetch.call_count, 1)
+
+
+class TestPrefetchRecords(unittest.TestCase):
+    PAGES = {
+        None: {"items": [{"id": 1}, {"id": 2}], "has_more": True, "page_token": "p2"},
+        "p2": {"items": [{"id": 3}], "has_more": True, "page_token": "p3"},
+        "p3": {"items": [{"id": 4}], "has_more": False},
+    }
+
+    def _fake(self, fail_once=None):
+        failed = []
+
+        def fake(app, table, size, token, *rest):
+            if token == fail_once and not failed:
+                failed.append(token)
+                raise ValueError("网络抖动")
+            return self.PAGES[token]
+        return fake
+
+    def test_same_records_as_serial(self):
+        with mock.patch.object(api, "bitable_list_records", side_effect=self._fake()):
+            ids = [r["id"] for r in api.bitable_iter_all_records_prefetch("app", "t")]
+        self.assertEqual(ids, [1, 2, 3, 4])
+
+    def test_failure_falls_back_to_serial_from_failed_page(self):
+        with mock.patch.object(api, "bitable_list_records", side_effect=self._fake(fail_once="p2")) as m:
+            ids = [r["id"] for r in api.bitable_iter_all_records_prefetch("app", "t")]
+        self.assertEqual(ids, [1, 2, 3, 4])
+        self.assertEqual([c.args[3] for c in m.call_args_list], [None, "p2", "p2", "p3"])
+
+    def test_early_close_stops_producer(self):
+        with mock.patch.object(api, "bitable_list_records", side_effect=self._fake()):
+            before = threading.active_count()
+            it = api.bitable_iter_all_records_prefetch("app", "t", prefetch=1)
+            next(it)
+            it.close()
+            deadline = time.time() + 2
+            while threading.active_count() > before and time.time() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(threading.active_count(), before)
+
+
+class TestDocxIterContent(unittest.TestCase):
+    PAGES = [
+        {"items": [
+            {"block_type": 1, "page": {"elements": [{"text_run": {"content": "标题"}}]}},
+            {"block_type": 2, "text": {"elements": [{"text_run": {"content": "第一"}}, {"text_run": {"content": "段"}}]}},
+        ], "has_more": True, "page_token": "p2"},
+        {"items": [
+            {"block_type": 22, "divider": {}},
+            {"block_type": 12, "bullet": {"elements": [{"text_run": {"content": "要点"}}]}},
+        ], "has_more": False},
+    ]
+
+    def test_text_streamed_across_pages(self):
+        with mock.patch.object(api, "_get", side_effect=self.PAGES) as get:
+            texts = list(api.docx_iter_content("doc"))
+        self.assertEqual(texts, ["标题", "第一段", "要点"])
+        self.assertEqual(get.call_args_list[1].args[1]["page_token"], "p2")
+
+
+class TestDocxAppendBlocks(unittest.TestCase):
+    def setUp(self):
+        api._docx_limiters.clear()
+        self.addCleanup(api._docx_limiters.clear)
+
+    def test_limiter_per_document(self):
+        self.assertIs(api._docx_limiter("a"), api._docx_limiter("a"))
+        self.assertIsNot(api._docx_limiter("a"), api._docx_limiter("b"))
+
+    def test_skip_failed_rewrites_block_by_block(self):
+        written = []
+
+        def fake(doc, parent, children):
+            if len(children) > 1 or children[0] == "坏":
+                raise RuntimeError("x")
+            written.append(children[0])
+
+        with mock.patch.object(api, "DOCX_WRITE_RATE", 1000), \
+             mock.patch.object(api, "call_with_retry", side_effect=lambda fn, *a, **kw: fn(*a)), \
+             mock.patch.object(api, "docx_create_block", side_effect=fake):
+            api.docx_append_blocks("doc", ["一", "坏", "三"], skip_failed=True)
+            with self.assertRaises(RuntimeError):
+                api.docx_append_blocks("doc", ["一", "二"])
+        self.assertEqual(written, ["一", "三"])
+
+
+class TestWikiWalkTree(unittest.TestCase):
+    TREE = {
+        None: [{"node_token": "a", "has_child": True}, {"node_token": "b", "has_child": False}],
+        "a": [{"node_token": "a1", "has_child": True}, {"node_token": "a2"}],
+        "a1": [{"node_token": "a1x", "has_child": False}],
+    }
+
+    def test_level_order_with_ancestors(self):
+        with mock.patch.object(api, "wiki_list_nodes", side_effect=lambda space, parent: self.TREE[parent]):
+            nodes = api.wiki_walk_tree("sp")
+        self.assertEqual([(n["node_token"], n["ancestors"]) for n in nodes],
+                         [("a", []), ("b", []), ("a1", ["a"]), ("a2", ["a"]), ("a1x", ["a", "a1"])])
+
+    def test_siblings_expanded_concurrently(self):
+        gate = threading.Barrier(2, timeout=5)
+        tree = {None: [{"node_token": "x", "has_child": True}, {"node_token": "y", "has_child": True}]}
+
+        def fake(space, parent):
+            if parent:
+                gate.wait()  # x 和 y 必须同时在展开才能通过
+                return []
+            return tree[None]
+
+        with mock.patch.object(api, "wiki_list_nodes", side_effect=fake):
+            self.assertEqual(len(api.wiki_walk_tree("sp")), 2)
+
+
+class TestCheck(unittest.TestCase):
+    def test_http_error_carries_response(self):
+        resp = mock.Mock(status_code=429, url="u")
+        with self.assertRaises(api.requests.HTTPError) as cm:
+            api._check(resp, "/x")
+        self.assertIs(cm.exception.response, resp)
+
+    def test_business_error(self):
+        resp = mock.Mock(status_code=200, content=b'{"code": 99, "msg": "bad"}')
+        with self.assertRaisesRegex(Exception, "API 错误 \\[/x\\]: bad"):
+            api._check(resp, "/x")
+
+    def test_session_requests_compression(self):
+        self.assertIn("gzip", api._SESSION.headers["Accept-Encoding"])
+
+    def test_http2_client_is_opt_in(self):
+        with mock.patch.dict(os.environ, {"FEISHU_HTTP2": ""}):
+            self.assertIsNone(api._make_http2_client())
+
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        patches = [mock.patch.object(api, "_headers", return_value={}),
+                   mock.patch.dict(api._etag_cache, clear=True)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_304_reuses_cached_data(self):
+        first = mock.Mock(status_code=200, content=b'{"code": 0, "data": {"items": [1]}}', headers={"ETag": "v1"})
+        second = mock.Mock(status_code=304, headers={})
+        with mock.patch.object(api._HTTP, "get", side_effect=[first, second]) as get:
+            self.assertEqual(api._get("/p", cache_key="k"), {"items": [1]})
+            self.assertEqual(api._get("/p", cache_key="k"), {"items": [1]})
+        self.assertEqual(get.call_args_list[1].kwargs["headers"]["If-None-Match"], "v1")
+
+    def test_no_cache_key_sends_no_validator(self):
+        resp = mock.Mock(status_code=200, content=b'{"code": 0, "data": {}}', headers={"ETag": "v1"})
+        with mock.patch.object(api._HTTP, "get", return_value=resp) as get:
+            api._get("/p")
+            api._get("/p")
+        self.assertNotIn("If-None-Match", get.call_args.kwargs["headers"])
+        self.assertEqual(api._etag_cache, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""test_report_generator.py — 定时报告调度单元测试（不调 API）"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import report_generator as rg
+
+
+def _job(**schedule):
+    return {"id": "j", "schedule": schedule}
+
+
+class TestIsJobDue(unittest.TestCase):
+    MON_10 = datetime(2026, 3, 2, 10, 0)  # 周一 10:00
+
+    def test_daily_before_and_after_time(self):
+        job = _job(frequency="daily", time="09:30")
+        self.assertTrue(rg.is_job_due(job, {}, self.MON_10))
+        self.assertFalse(rg.is_job_due(job, {}, datetime(2026, 3, 2, 9, 29)))
+
+    def test_daily_already_ran_today(self):
+        state = {"j": {"last_run": "2026-03-02T09:31:00"}}
+        self.assertFalse(rg.is_job_due(_job(frequency="daily", time="09:30"), state, self.MON_10))
+
+    def test_weekly_wrong_day_skips_state(self):
+        state = {"j": {"last_run": "not-a-date"}}  # 日期不对时不应解析上次运行时间
+        self.assertFalse(rg.is_job_due(_job(frequency="weekly", day_of_week=3), state, self.MON_10))
+        self.assertTrue(rg.is_job_due(_job(frequency="weekly", day_of_week=1), {}, self.MON_10))
+
+    def test_monthly(self):
+        self.assertFalse(rg.is_job_due(_job(frequency="monthly", day_of_month=1), {}, self.MON_10))
+        self.assertTrue(rg.is_job_due(_job(frequency="monthly", day_of_month=2), {}, self.MON_10))
+
+    def test_hourly_interval(self):
+        job = _job(frequency="hourly", interval_hours=4)
+        self.assertTrue(rg.is_job_due(job, {}, self.MON_10))
+        self.assertFalse(rg.is_job_due(job, {"j": {"last_run": "2026-03-02T07:00:00"}}, self.MON_10))
+        self.assertTrue(rg.is_job_due(job, {"j": {"last_run": "2026-03-02T06:00:00"}}, self.MON_10))
+
+    def test_unknown_frequency(self):
+        self.assertFalse(rg.is_job_due(_job(frequency="yearly"), {}, self.MON_10))
+
+    def test_epoch_last_run_preferred(self):
+        job = _job(frequency="daily", time="09:30")
+        yesterday = datetime(2026, 3, 1, 9, 31).timestamp()
+        state = {"j": {"last_run": "2026-03-02T09:31:00", "last_run_ts": int(yesterday)}}
+        self.assertTrue(rg.is_job_due(job, state, self.MON_10))
+
+    def test_preparsed_schedule_used(self):
+        job = _job(frequency="daily", time="09:30")
+        job["_sched"] = rg._compile_schedule({"frequency": "daily", "time": "10:30"})
+        self.assertFalse(rg.is_job_due(job, {}, self.MON_10))
+
+
+class TestStateFile(unittest.TestCase):
+    STATE = {"daily_audit": {"last_run": "2026-03-02T09:00:00", "last_status": "error", "last_error": "超时"}}
+
+    def _roundtrip(self):
+        path = os.path.join(tempfile.mkdtemp(), "state.json")
+        with mock.patch.object(rg, "STATE_FILE", path):
+            rg.save_state(self.STATE)
+            return rg.load_state()
+
+    def test_roundtrip(self):
+        self.assertEqual(self._roundtrip(), self.STATE)
+
+    def test_roundtrip_without_orjson(self):
+        with mock.patch.object(rg, "orjson", None):
+            self.assertEqual(self._roundtrip(), self.STATE)
+
+
+class TestRunDueJobs(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.schedule = os.path.join(tmp, "schedule.yaml")
+        with open(self.schedule, "w", encoding="utf-8") as f:
+            f.write("jobs:\n"
+                    "  - {id: a, type: t, schedule: {frequency: hourly}}\n"
+                    "  - {id: b, type: t, schedule: {frequency: hourly}}\n"
+                    "  - {id: c, type: t, enabled: false}\n")
+        patch = mock.patch.object(rg, "STATE_FILE", os.path.join(tmp, "state.json"))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_jobs_run_concurrently_in_schedule_order(self):
+        gate = threading.Barrier(2, timeout=5)
+
+        def runner(job):
+            gate.wait()  # 两个任务必须同时在跑才能通过
+            if job["id"] == "b":
+                raise RuntimeError("boom")
+            return {"id": job["id"]}
+
+        with mock.patch.dict(rg.REPORT_RUNNERS, {"t": runner}):
+            results = rg.run_due_jobs(self.schedule)
+        self.assertEqual([(r["job_id"], r["status"]) for r in results], [("a", "success"), ("b", "error")])
+        state = rg.load_state()
+        self.assertEqual(state["a"]["last_status"], "success")
+        self.assertEqual(state["b"]["last_error"], "boom")
+        self.assertIsInstance(state["a"]["last_run_ts"], int)
+        self.assertNotIn("c", state)
+
+
+class TestCustomReport(unittest.TestCase):
+    def test_module_with_run_called_in_process(self):
+        fake = mock.Mock()
+        fake.run.return_value = {"rows": 3}
+        with mock.patch.object(rg, "_import", return_value=fake) as imp:
+            out = rg.run_custom_report({"params": {"script": "my_job.py", "args": ["--x"], "in_process": True}})
+        imp.assert_called_once_with("my_job")
+        fake.run.assert_called_once_with(["--x"])
+        self.assertEqual(out["result"], {"rows": 3})
+        self.assertEqual((out["returncode"], out["stdout"], out["stderr"]), (0, "", ""))
+
+    def test_scripts_dir_module_not_imported_without_opt_in(self):
+        completed = mock.Mock(returncode=0, stdout="ok\n", stderr="")
+        with mock.patch.object(rg, "_import") as imp, \
+             mock.patch("subprocess.run", return_value=completed) as run:
+            out = rg.run_custom_report({"params": {"script": "my_job.py"}})
+        imp.assert_not_called()
+        run.assert_called_once()
+        self.assertEqual(out["stdout"], "ok\n")
+
+    def test_in_process_sys_exit_becomes_returncode(self):
+        for code, expected in ((None, 0), (3, 3), ("用法错误", 1)):
+            fake = mock.Mock()
+            fake.run.side_effect = SystemExit(code)
+            with mock.patch.object(rg, "_import", return_value=fake):
+                out = rg.run_custom_report({"params": {"script": "my_job.py", "in_process": True}})
+            self.assertEqual(out["returncode"], expected)
+            self.assertNotIn("result", out)
+        self.assertEqual(out["stderr"], "用法错误")
+
+    def test_script_outside_scripts_dir_uses_subprocess(self):
+        script = os.path.join(tempfile.mkdtemp(), "job.py")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write("import sys\nprint('hi', sys.argv[1])\ndef run(args):\n    raise AssertionError\n")
+        out = rg.run_custom_report({"params": {"script": script, "args": ["x"]}})
+        self.assertEqual(out["returncode"], 0)
+        self.assertEqual(out["stdout"], "hi x\n")
+
+    def test_in_process_timeout(self):
+        with self.assertRaises(TimeoutError):
+            rg._call_with_timeout(lambda args: time.sleep(1), [], 0.05)
+
+    def test_in_process_inherits_request_scope(self):
+        api = rg._import("feishu_api")
+        with api.with_request_scope():
+            scope = api._request_scope.get()
+            seen = rg._call_with_timeout(lambda args: api._request_scope.get(), [], 1)
+        self.assertIs(seen, scope)
+
+
+class TestTemplateReport(unittest.TestCase):
+    def test_template_read_once_across_jobs(self):
+        path = os.path.join(tempfile.mkdtemp(), "t.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("共 {{total}} 条")
+        dw = rg._import("doc_workflow")
+        job = {"params": {"app_token": "a", "table_id": "t", "template": path}}
+        real_open = open
+        with mock.patch.object(dw, "build_context_from_bitable", return_value={"total": 3}), \
+             mock.patch("builtins.open", side_effect=real_open) as opened:
+            outputs = [rg.run_template_report(job) for _ in range(3)]
+        self.assertEqual([o["content"] for o in outputs], ["共 3 条"] * 3)
+        self.assertEqual([c.args[0] for c in opened.call_args_list].count(path), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,9 @@
 
 import os
 import sys
+import tempfile
 import unittest
+from unittest import mock
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
 import retail_audit as ra
@@ -24,9 +26,11 @@ def _store(**kw):
 class TestRuleCheckers(unittest.TestCase):
     """测试各审计规则的触发逻辑"""
 
-    def setUp(self):
-        self.cfg = ra.load_config()
-        self.fm = self.cfg["field_mapping"]
+    @classmethod
+    def setUpClass(cls):
+        # 各用例只读字段映射，整个类共用一份配置
+        cls.cfg = ra.load_config()
+        cls.fm = cls.cfg["field_mapping"]
 
     def test_sell_through_high_triggers(self):
         store = _store(期初库存=100, 销售数量=95, 当前库存=5)
@@ -109,6 +113,13 @@ class TestRuleCheckers(unittest.TestCase):
         result = ra.RULE_CHECKERS["low_sell_rate"](store, {}, t, self.fm)
         self.assertIsNone(result)
 
+    def test_registry_checker_accepts_partial_mapping(self):
+        # 单独调用时映射不全也按缺省列名取值，与 run_audit 一致
+        closed = {"实际销售额": 0, "营业状态": "停业"}
+        self.assertIsNone(ra.RULE_CHECKERS["zero_sales"](closed, {}, {}, {"actual_sales": "实际销售额"}))
+        self.assertIsNotNone(ra.RULE_CHECKERS["negative_inventory"]({"current_stock": -1}, {}, {}, {}))
+        self.assertIsNone(ra.RULE_CHECKERS["low_sell_rate"]({}, {}, {}, {}))
+
 
 class TestRunAudit(unittest.TestCase):
     def test_healthy_store(self):
@@ -140,12 +151,49 @@ class TestRunAudit(unittest.TestCase):
         self.assertEqual(len(scores), 1)
         self.assertLessEqual(scores[0]["评分"], 75)
 
+    def test_score_is_penalty_sum_clamped(self):
+        cfg = ra.load_config()
+        scoring = cfg.get("scoring", ra.DEFAULT_SCORING)
+        result = ra.run_audit(ra.generate_demo_data(50), config=cfg)
+        for entry in result["store_scores"]:
+            levels = [a["级别"] for a in result["alerts"] if a["门店"] == entry["门店"]]
+            expected = 100 - sum(scoring.get(f"{lv}_penalty", 10) for lv in levels)
+            self.assertEqual(entry["评分"], max(expected, 0))
+            self.assertEqual(entry["异常数"], len(levels))
+
+    def test_scores_sorted_ties_keep_input_order(self):
+        stores = [_store(门店名称="A"), _store(门店名称="B", 当前库存=-1), _store(门店名称="C")]
+        names = [s["门店"] for s in ra.run_audit(stores)["store_scores"]]
+        self.assertEqual(names, ["B", "A", "C"])
+
     def test_demo_data_runs(self):
         stores = ra.generate_demo_data(10)
         result = ra.run_audit(stores)
         self.assertEqual(result["total_stores"], 10)
         self.assertEqual(len(result["store_scores"]), 10)
 
+    def test_alerts_partitioned_by_level(self):
+        result = ra.run_audit(ra.generate_demo_data(30))
+        by_level = result["alerts_by_level"]
+        for level, alerts in by_level.items():
+            self.assertEqual(alerts, [a for a in result["alerts"] if a["级别"] == level])
+        self.assertEqual(sum(map(len, by_level.values())), len(result["alerts"]))
+        # 分组只持有引用，不复制告警
+        ids = {id(a) for a in result["alerts"]}
+        self.assertTrue(all(id(a) in ids for alerts in by_level.values() for a in alerts))
+
+    def test_field_mapping_compiled_once_per_run(self):
+        with mock.patch.object(ra, "_compile_field_mapping", wraps=ra._compile_field_mapping) as compile_fm:
+            ra.run_audit(ra.generate_demo_data(20))
+        self.assertEqual(compile_fm.call_count, 1)
+
+    def test_generator_input(self):
+        stores = ra.generate_demo_data(10)
+        from_list = ra.run_audit(stores)
+        from_gen = ra.run_audit(s for s in stores)
+        self.assertEqual(from_gen["total_stores"], 10)
+        self.assertEqual(from_gen["summary"], from_list["summary"])
+
 
 class TestReportGeneration(unittest.TestCase):
     def test_markdown_report_structure(self):
@@ -161,6 +209,32 @@ class TestReportGeneration(unittest.TestCase):
         md = ra.generate_report_markdown(result)
         self.assertIn("门店总数：0", md)
 
+    def test_blocks_match_markdown(self):
+        for n in (0, 7):
+            result = ra.run_audit(ra.generate_demo_data(n))
+            md = ra.generate_report_markdown(result)
+            self.assertEqual(list(ra.iter_report_blocks(result)), ra._markdown_to_blocks(md))
+
+    def test_csv_output(self):
+        import csv
+        result = ra.run_audit([_store(门店名称="A", 当前库存=-1), _store(门店名称="B")])
+        result["alerts"][0]["自定义"] = "x"  # 额外字段追加成列
+        paths = ra.write_audit_csv(result, tempfile.mkdtemp())
+        with open(paths["alerts"], encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), len(result["alerts"]))
+        self.assertEqual(rows[0]["自定义"], "x")
+        self.assertEqual(rows[0]["门店"], "A")
+        with open(paths["store_scores"], encoding="utf-8", newline="") as f:
+            scores = list(csv.reader(f))
+        self.assertEqual(scores[0], list(ra.SCORE_CSV_COLUMNS))
+        self.assertEqual([r[1] for r in scores[1:]], [s["门店"] for s in result["store_scores"]])
+
+    def test_result_without_partition(self):
+        result = ra.run_audit(ra.generate_demo_data(10))
+        legacy = {k: v for k, v in result.items() if k != "alerts_by_level"}
+        self.assertEqual(ra.generate_report_markdown(legacy), ra.generate_report_markdown(result))
+
 
 class TestConfigLoading(unittest.TestCase):
     def test_default_config(self):
@@ -187,6 +261,130 @@ class TestConfigLoading(unittest.TestCase):
         types = [a["异常类型"] for a in result["alerts"]]
         self.assertNotIn("负库存", types)
 
+    def test_disabled_checker_never_called(self):
+        cfg = ra.load_config()
+        cfg["rules"]["negative_inventory"]["enabled"] = False
+        checker = mock.Mock(return_value=None)
+        with mock.patch.dict(ra.RULE_CHECKERS, {"negative_inventory": checker}):
+            ra.run_audit(ra.generate_demo_data(10), config=cfg)
+        checker.assert_not_called()
+
+    def test_rule_bound_once_per_run(self):
+        checker = ra.RULE_CHECKERS["low_sell_rate"]
+        factory = mock.Mock(wraps=ra._RULE_FACTORIES[checker])
+        with mock.patch.dict(ra._RULE_FACTORIES, {checker: factory}):
+            result = ra.run_audit([_store(有销SKU数=10), _store(), _store(有销SKU数=20)])
+        factory.assert_called_once()  # 阈值和列名整次运行只取一次
+        self.assertEqual(sum(a["异常类型"] == "动销率过低" for a in result["alerts"]), 2)
+
+    def test_plain_checker_signature_still_supported(self):
+        calls = []
+
+        def checker(store, ctx, t, fm):
+            calls.append((t, fm["current_stock"]))
+            return {"指标": "x", "详情": "", "建议": ""} if store[fm["current_stock"]] < 0 else None
+
+        cfg = ra.load_config()
+        cfg["rules"]["negative_inventory"]["thresholds"] = {"k": 1}
+        with mock.patch.dict(ra.RULE_CHECKERS, {"negative_inventory": checker}):
+            result = ra.run_audit([_store(当前库存=-1), _store()], config=cfg)
+        self.assertEqual(calls, [({"k": 1}, "当前库存")] * 2)
+        self.assertEqual([a["指标"] for a in result["alerts"] if a["异常类型"] == "负库存"], ["x"])
+
+    def test_bind_rule_accepts_raw_mapping(self):
+        seen = []
+        plain = lambda store, ctx, t, fm: seen.append(fm["status"])
+        ra._bind_rule(plain, {}, {"actual_sales": "s"})({}, {})
+        self.assertEqual(seen, ["营业状态"])
+        check = ra._bind_rule(ra.RULE_CHECKERS["zero_sales"], {}, {"actual_sales": "s"})
+        self.assertIsNone(check({"s": 0, "营业状态": "停业"}, {}))
+        self.assertIsNotNone(check({"s": 0, "营业状态": "营业"}, {}))
+
+    def test_custom_level_counted(self):
+        cfg = ra.load_config()
+        cfg["rules"]["negative_inventory"]["level"] = "urgent"
+        result = ra.run_audit([_store(当前库存=-1), _store(当前库存=-2)], config=cfg)
+        self.assertEqual(result["summary"]["urgent"], 2)
+
+    def test_partial_field_mapping(self):
+        cfg = ra.load_config()
+        cfg["field_mapping"] = {"current_stock": "库存"}  # 其余字段按键名本身取值
+        result = ra.run_audit([{"库存": -1, "actual_sales": 10}], config=cfg)
+        types = [a["异常类型"] for a in result["alerts"]]
+        self.assertIn("负库存", types)
+        self.assertNotIn("零销售", types)
+
+    def test_unmapped_status_uses_default_column(self):
+        cfg = ra.load_config()
+        cfg["field_mapping"] = {"actual_sales": "s"}  # 未配置 status
+        result = ra.run_audit([{"s": 0, "营业状态": "停业"}], config=cfg)
+        self.assertNotIn("零销售", [a["异常类型"] for a in result["alerts"]])
+
+    def test_config_cached_by_mtime(self):
+        path = os.path.join(tempfile.mkdtemp(), "c.yaml")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("industry: A\nrules: {}\n")
+        cfg = ra.load_config(path)
+        cfg["industry"] = "改过"  # 调用方修改不应影响缓存
+        cfg["rules"]["x"] = {}
+        self.assertEqual(ra.load_config(path), {"industry": "A", "rules": {}})
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("industry: B\nrules: {}\n")
+        os.utime(path, (0, os.path.getmtime(path) + 10))
+        self.assertEqual(ra.load_config(path)["industry"], "B")
+        self.assertEqual(ra._yaml_cache[path][0], os.path.getmtime(path))  # 旧版本已被替换，不随改动累积
+
+
+class TestPublish(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(ra.api, "DOCX_WRITE_RATE", 1000)
+        patch.start()
+        self.addCleanup(patch.stop)
+        ra.api._docx_limiters.clear()
+        self.addCleanup(ra.api._docx_limiters.clear)
+
+    def test_blocks_written_in_order(self):
+        md = "# 标题\n" + "\n".join(f"- 第{i}行" for i in range(120))
+        chunks = []
+        with mock.patch.object(ra.api, "docx_create_block", side_effect=lambda d, p, c: chunks.append(c)):
+            self.assertEqual(ra.publish_report_to_feishu(md, doc_token="doc"), "doc")
+        self.assertEqual([len(c) for c in chunks], [50, 50, 21])
+        self.assertEqual(sum(chunks, []), ra._markdown_to_blocks(md))
+
+    def test_prebuilt_blocks_skip_markdown(self):
+        result = ra.run_audit(ra.generate_demo_data(3))
+        chunks = []
+        with mock.patch.object(ra.api, "docx_create_block", side_effect=lambda d, p, c: chunks.append(c)), \
+             mock.patch.object(ra, "_markdown_to_blocks") as parse:
+            ra.publish_report_to_feishu(blocks=ra.iter_report_blocks(result), doc_token="doc")
+        parse.assert_not_called()
+        self.assertEqual(sum(chunks, []), list(ra.iter_report_blocks(result)))
+
+    def test_report_and_title_use_audit_date(self):
+        result = ra.run_audit([_store()])
+        result["audit_time"] = "2026-01-31T23:59:59"
+        date_str = ra.report_date(result)
+        self.assertEqual(date_str, "2026-01-31")
+        self.assertIn("门店运营诊断报告 2026-01-31", ra.generate_report_markdown(result))
+        with mock.patch.object(ra.api, "docx_create_document", return_value={"document": {"document_id": "d"}}) as create, \
+             mock.patch.object(ra.api, "docx_create_block"):
+            ra.publish_report_to_feishu(blocks=ra.iter_report_blocks(result, date_str), date_str=date_str)
+        self.assertEqual(create.call_args.args[0], "门店运营诊断报告 2026-01-31")
+
+    def test_failed_batch_retried_block_by_block(self):
+        md = "\n".join(f"- 第{i}行" for i in range(3))
+        written = []
+
+        def fake(doc, parent, children):
+            if len(children) > 1 or children[0]["bullet"]["elements"][0]["text_run"]["content"] == "第1行":
+                raise ValueError("bad block")
+            written.append(children[0])
+
+        with mock.patch.object(ra.api, "docx_create_block", side_effect=fake):
+            ra.publish_report_to_feishu(md, doc_token="doc")
+        self.assertEqual([b["bullet"]["elements"][0]["text_run"]["content"] for b in written], ["第0行", "第2行"])
+
 
 if __name__ == "__main__":
     unittest.main()
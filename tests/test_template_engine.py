@@ -3,7 +3,9 @@
 
 import os
 import sys
+import tempfile
 import unittest
+from unittest import mock
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
 import doc_workflow as dw
@@ -26,8 +28,22 @@ class TestSimpleVariables(unittest.TestCase):
 
     def test_number_formatting(self):
         self.assertEqual(dw.render_template("{{val}}", {"val": 3.0}), "3")
+
+    def test_repeated_render_tokenizes_once(self):
+        source = "Hi {{name}} {{#if flag}}!{{/if}} #tokenize-once"
+        with mock.patch.object(dw, "_tokenize", wraps=dw._tokenize) as tokenize:
+            outputs = {dw.render_template(source, {"name": n, "flag": 1}) for n in ("甲", "乙", "甲")}
+        self.assertEqual(outputs, {"Hi 甲 ! #tokenize-once", "Hi 乙 ! #tokenize-once"})
+        self.assertEqual(tokenize.call_count, 1)
         self.assertEqual(dw.render_template("{{val}}", {"val": 3.14}), "3.14")
 
+    def test_flat_template_skips_block_machinery(self):
+        with mock.patch.object(dw, "_exec_ops", wraps=dw._exec_ops) as exec_ops:
+            out = dw.render_template("{{name}}|{{a.b}}|{{TODAY}}|{{nope}}", {"name": "x", "a": {"b": 2.0}})
+            dw.render_template("{{#if nope}}{{name}}{{/if}}", {"name": "x"})  # 含块的模板仍走 _exec_ops
+        self.assertRegex(out, r"^x\|2\|\d{4}-\d{2}-\d{2}\|\{\{nope\}\}$")
+        self.assertEqual(exec_ops.call_count, 1)
+
     def test_list_value(self):
         self.assertEqual(dw.render_template("{{tags}}", {"tags": ["a", "b"]}), "a, b")
 
@@ -49,6 +65,16 @@ class TestBuiltinVariables(unittest.TestCase):
         self.assertIn("~", result)
         self.assertNotIn("{{", result)
 
+    def test_context_overrides_builtin(self):
+        self.assertEqual(dw.render_template("{{TODAY}}|{{NOW}}", {"TODAY": "昨天"})[:3], "昨天|")
+
+    def test_builtins_computed_once_and_only_when_used(self):
+        with mock.patch.object(dw, "_builtin_vars", wraps=dw._builtin_vars) as builtins:
+            dw.render_template("{{name}}", {"name": "x"})
+            self.assertEqual(builtins.call_count, 0)
+            dw.render_template("{{TODAY}} {{NOW}} {{#each rows}}{{WEEK_END}}{{/each}}", {"rows": [{}, {"a": 1}]})
+            self.assertEqual(builtins.call_count, 1)
+
 
 class TestEachLoop(unittest.TestCase):
     def test_basic_loop(self):
@@ -97,6 +123,17 @@ class TestIfCondition(unittest.TestCase):
         tpl = "{{#if items}}HAS{{/if}}"
         self.assertEqual(dw.render_template(tpl, {"items": []}), "")
 
+    def test_falsy_zero_and_empty_containers(self):
+        tpl = "{{#if v}}YES{{/if}}"
+        for val in (0, 0.0, "", {}, (), False):
+            self.assertEqual(dw.render_template(tpl, {"v": val}), "")
+
+    def test_falsy_branch_not_evaluated(self):
+        tpl = "{{#if show}}{{TODAY}}{{#each rows}}{{NOW}}{{/each}}{{/if}}"
+        with mock.patch.object(dw, "_builtin_vars", wraps=dw._builtin_vars) as builtins:
+            self.assertEqual(dw.render_template(tpl, {"show": [], "rows": [{"a": 1}]}), "")
+            self.assertEqual(builtins.call_count, 0)
+
     def test_chinese_field_if(self):
         tpl = "{{#if 状态}}有状态{{/if}}"
         self.assertEqual(dw.render_template(tpl, {"状态": "完成"}), "有状态")
@@ -110,6 +147,33 @@ class TestIfCondition(unittest.TestCase):
         self.assertNotIn("[]", result)
 
 
+class TestNestedBlocks(unittest.TestCase):
+    def test_nested_if(self):
+        tpl = "{{#if a}}A{{#if b}}B{{/if}}!{{/if}}"
+        self.assertEqual(dw.render_template(tpl, {"a": 1, "b": 0}), "A!")
+        self.assertEqual(dw.render_template(tpl, {"a": 1, "b": 1}), "AB!")
+        self.assertEqual(dw.render_template(tpl, {"a": 0, "b": 1}), "")
+
+    def test_nested_each_reads_item_list(self):
+        tpl = "{{#each groups}}{{name}}: {{#each tags}}{{this}} {{/each}}{{/each}}"
+        ctx = {"groups": [{"name": "g1", "tags": ["a", "b"]}, {"name": "g2", "tags": ["c"]}]}
+        self.assertEqual(dw.render_template(tpl, ctx), "g1: a \nb \ng2: c ")
+
+    def test_unbalanced_tags_kept_literal(self):
+        self.assertEqual(dw.render_template("{{/if}}{{x}}", {"x": 1}), "{{/if}}1")
+        self.assertEqual(dw.render_template("{{#if x}}{{x}}", {"x": 1}), "{{#if x}}1")
+
+    def test_braces_inside_placeholder(self):
+        self.assertEqual(dw.render_template("{{{x}}", {"x": 1}), "{1")
+        self.assertEqual(dw.render_template("{{a}b}}", {"a": 1}), "{{a}b}}")
+
+    def test_large_template_linear(self):
+        tpl = "{{x}} " * 20000 + "{{#if x}}" * 2000
+        out = dw.render_template(tpl, {"x": 1})
+        self.assertTrue(out.startswith("1 1 "))
+        self.assertTrue(out.endswith("{{#if x}}"))
+
+
 class TestResolveHelpers(unittest.TestCase):
     def test_to_str_none(self):
         self.assertEqual(dw._to_str(None), "")
@@ -118,6 +182,25 @@ class TestResolveHelpers(unittest.TestCase):
         self.assertEqual(dw._to_str(5.0), "5")
         self.assertEqual(dw._to_str(3.14), "3.14")
 
+    def test_to_str_exact_types(self):
+        self.assertEqual(dw._to_str(7), "7")
+        self.assertEqual(dw._to_str(True), "True")
+        self.assertEqual(dw._to_str(["a", 1]), "a, 1")
+
+    def test_to_str_float_subclass_and_non_finite(self):
+        class Money(float):
+            pass
+        self.assertEqual(dw._to_str(Money(12.0)), "12")
+        self.assertEqual(dw._to_str(Money(1.005)), "1.00")
+        self.assertEqual(dw._to_str(-0.0), "0")
+        self.assertEqual(dw._to_str(float("inf")), "inf")
+        self.assertEqual(dw._to_str(float("nan")), "nan")
+
+    def test_each_repeated_floats(self):
+        items = [{"v": 2.5}, {"v": 1.0}, {"v": 2.5}, {"v": True}, {"v": 1}]
+        out = dw.render_template("{{#each items}}{{v}}{{/each}}", {"items": items})
+        self.assertEqual(out, "2.50\n1\n2.50\nTrue\n1")
+
     def test_extract_display_value_rich_text(self):
         raw = [{"text": "hello "}, {"text": "world"}]
         self.assertEqual(dw._extract_display_value(raw, 1), "hello world")
@@ -131,5 +214,84 @@ class TestResolveHelpers(unittest.TestCase):
         self.assertEqual(dw._extract_display_value(raw, 15), "Google")
 
 
+class TestBuildContext(unittest.TestCase):
+    FIELDS = [
+        {"field_name": "名称", "type": 1},
+        {"field_name": "金额", "type": 2},
+        {"field_name": "状态", "type": 3},
+    ]
+    RECORDS = [
+        {"fields": {"名称": [{"text": "甲"}], "金额": 10, "状态": "完成"}},
+        {"fields": {"名称": [{"text": "乙"}], "金额": "2.5", "状态": "完成"}},
+        {"fields": {"名称": [{"text": "丙"}], "状态": "进行中"}},
+    ]
+
+    def _context(self, **kw):
+        with mock.patch.object(dw.api, "bitable_list_fields", return_value=self.FIELDS), \
+             mock.patch.object(dw.api, "bitable_list_all_records_cached", return_value=self.RECORDS):
+            return dw.build_context_from_bitable("app", "tbl", **kw)
+
+    def test_records_and_summary(self):
+        ctx = self._context()
+        self.assertEqual(ctx["records"][0]["名称"], "甲")
+        self.assertEqual(ctx["summary"]["by_状态"], {"完成": 2, "进行中": 1})
+        self.assertEqual(ctx["summary"]["金额_sum"], 12.5)
+        self.assertEqual(ctx["summary"]["金额_max"], 10)
+
+    def test_group_by(self):
+        ctx = self._context(group_by="状态")
+        self.assertEqual(len(ctx["groups"]["完成"]), 2)
+
+
+class TestTemplateFromPath(unittest.TestCase):
+    def _write(self, path, text, mtime):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.utime(path, (mtime, mtime))
+
+    def test_cached_until_mtime_changes(self):
+        path = os.path.join(tempfile.mkdtemp(), "t.md")
+        self._write(path, "Hi {{name}}", 1_000_000)
+        first = dw.Template.from_path(path)
+        self.assertIs(dw.Template.from_path(path), first)
+        self.assertEqual(first.render({"name": "甲"}), "Hi 甲")
+
+        self._write(path, "Bye {{name}}", 1_000_060)
+        self.assertEqual(dw.Template.from_path(path).render({"name": "甲"}), "Bye 甲")
+
+    def test_item_values_not_rerendered(self):
+        tpl = dw.Template("{{#each items}}{{v}}{{/each}}")
+        self.assertEqual(tpl.render({"items": [{"v": "{{TODAY}}"}]}), "{{TODAY}}")
+
+    def test_each_body_all_opcodes(self):
+        source = ("{{#each rows}}{{@index}}.{{名称}} {{#if 价格}}¥{{价格}}{{/if}}{{缺失}} {{g}}"
+                  "{{#each 子项}}[{{this}}]{{/each}}{{/each}}")
+        items = [{"名称": f"n{i}", "价格": [0, 1.5, None][i % 3], "子项": [i]} for i in range(3)]
+        items += [{}, {"名称": ""}, "标量", {"@index": "自带"}]
+        out = dw.Template(source).render({"rows": items, "g": "全局", "价格": 9})
+        self.assertEqual(out.split("\n"), [
+            "0.n0 {{缺失}} 全局[0]",
+            "1.n1 ¥1.50{{缺失}} 全局[1]",
+            "2.n2 {{缺失}} 全局[2]",
+            "{{@index}}.{{名称}} ¥9{{缺失}} 全局",  # 非 dict 项：条件和变量取全局上下文
+            "自带.{{名称}} {{缺失}} 全局",
+        ])
+
+
+class TestGenerateDoc(unittest.TestCase):
+    def test_blocks_written_in_order_without_sleep(self):
+        path = os.path.join(tempfile.mkdtemp(), "t.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("# 标题\n" + "\n".join(f"- 第{i}行" for i in range(120)))
+        chunks = []
+        with mock.patch.object(dw.api, "docx_create_document", return_value={"document": {"document_id": "doc"}}), \
+             mock.patch.object(dw.api, "docx_create_block", side_effect=lambda d, p, c: chunks.append(c)), \
+             mock.patch.dict(dw.api._docx_limiters, {"doc": dw.api.RateLimiter(rate=1000)}):
+            result = dw.generate_doc(path, {})
+        self.assertEqual(result["title"], "标题")
+        self.assertEqual([len(c) for c in chunks], [50, 50, 21])
+        self.assertEqual(sum(chunks, []), dw._markdown_to_blocks(open(path, encoding="utf-8").read()))
+
+
 if __name__ == "__main__":
     unittest.main()